@@ -0,0 +1,79 @@
+"""
+Микробенчмарк короткой памяти диалогов (ConversationMemory)
+
+Запуск:
+    python -m benchmarks.bench_memory --users 100000 --turns 15
+"""
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+from utils.memory import ConversationMemory
+
+
+def _per_op(elapsed: float, ops: int) -> str:
+    return f"{elapsed / ops * 1e9:8.0f} нс/оп ({ops / elapsed:12,.0f} оп/с)"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк ConversationMemory")
+    parser.add_argument("--users", type=int, default=100_000, help="Количество пользователей")
+    parser.add_argument("--turns", type=int, default=15, help="Ходов на пользователя")
+    parser.add_argument("--max-messages", type=int, default=10, help="Размер истории (MAX_MESSAGES_HISTORY)")
+    parser.add_argument("--seed", type=int, default=1, help="Seed порядка пользователей")
+    args = parser.parse_args()
+
+    memory = ConversationMemory(max_messages=args.max_messages)
+    rng = random.Random(args.seed)
+    user_ids = list(range(1, args.users + 1))
+    text, reply = "сообщение пользователя " * 4, "ответ ассистента " * 12
+
+    tracemalloc.start()
+    # Ходы идут вперемешку между пользователями, как в реальном трафике
+    appends = 0
+    started = time.perf_counter()
+    for _ in range(args.turns):
+        rng.shuffle(user_ids)
+        for user_id in user_ids:
+            memory.add_user_message(user_id, text)
+            memory.add_assistant_message(user_id, reply)
+            appends += 1
+    append_time = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for user_id in user_ids:
+        memory.get_history(user_id)
+    cold_read_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for user_id in user_ids:
+        memory.get_history(user_id)
+    warm_read_time = time.perf_counter() - started
+
+    # Типичный ход: чтение истории, затем добавление пары сообщений
+    started = time.perf_counter()
+    for user_id in user_ids:
+        memory.get_history(user_id)
+        memory.add_user_message(user_id, text)
+        memory.add_assistant_message(user_id, reply)
+    turn_time = time.perf_counter() - started
+
+    stats = memory.get_stats()
+    expected = args.users * min(args.turns + 1, args.max_messages) * 2
+    assert stats["total_messages"] == expected, (stats, expected)
+
+    print(f"Пользователей: {args.users:,}, ходов: {args.turns}, история: {args.max_messages} сообщений")
+    print(f"Добавление пары (с вытеснением): {_per_op(append_time, appends)}")
+    print(f"Чтение истории (первое):         {_per_op(cold_read_time, args.users)}")
+    print(f"Чтение истории (повторное):      {_per_op(warm_read_time, args.users)}")
+    print(f"Ход (чтение + пара):             {_per_op(turn_time, args.users)}")
+    print(f"Память: {current / 2**20:.1f} МиБ (пик {peak / 2**20:.1f} МиБ), сообщений: {stats['total_messages']:,}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
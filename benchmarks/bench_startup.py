@@ -0,0 +1,52 @@
+"""
+Бенчмарк времени запуска: импорт обработчиков и инициализация слоя БД
+
+Запуск:
+    python -m benchmarks.bench_startup            # БД из настроек (.env)
+    python -m benchmarks.bench_startup --db-down  # БД недоступна
+"""
+import os
+import sys
+import time
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер времени запуска бота")
+    parser.add_argument("--db-down", action="store_true", help="Указать недоступный адрес БД")
+    parser.add_argument("--ready-timeout", type=float, default=30.0, help="Сколько ждать готовности БД, сек")
+    args = parser.parse_args()
+
+    if args.db_down:
+        os.environ["DB_HOST"] = "127.0.0.1"
+        os.environ["DB_PORT"] = "1"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("DB_PASSWORD", "benchmark")
+
+    t0 = time.perf_counter()
+    from handlers.commands import register_command_handlers  # noqa: F401
+    from handlers.messages import register_message_handlers  # noqa: F401
+    from utils.database import db_manager
+    t_import = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    db_manager.start()
+    t_start = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    ready = db_manager.wait_ready(args.ready_timeout)
+    t_ready = time.perf_counter() - t0
+
+    print(f"Импорт обработчиков:        {t_import * 1000:8.1f} мс")
+    print(f"db_manager.start():         {t_start * 1000:8.1f} мс")
+    if ready:
+        print(f"Готовность БД:              {t_ready * 1000:8.1f} мс (версия схемы {db_manager.schema_version})")
+    else:
+        print(f"БД не готова за {args.ready_timeout:.0f} с (запуск бота при этом не блокируется)")
+    print(f"Время до начала polling:    {(t_import + t_start) * 1000:8.1f} мс")
+    db_manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,107 @@
 """
 Основной файл запуска Telegram бота
 """
+import time
+import signal
+import threading
 import traceback
 import logging
 from datetime import datetime
 from telebot import TeleBot
 
-from config.logging_config import setup_logging
+from config.logging_config import setup_logging, stop_logging
 from config.settings import Settings
 from handlers.commands import register_command_handlers
-from handlers.messages import register_message_handlers
+from handlers.messages import register_message_handlers, resume_pending_turns, start_thesis_idle_sweeper, admission, thesis_scheduler
+from utils.database import db_manager
 
 # Настройка логирования
-logger = setup_logging(Settings.LOG_DIR)
+logger = setup_logging(Settings.LOG_DIR, async_mode=Settings.LOG_ASYNC, json_format=Settings.LOG_JSON)
 
 # Валидация настроек
 Settings.validate()
 
 # Инициализация Telegram бота
-bot = TeleBot(Settings.TELEGRAM_BOT_TOKEN)
+bot = TeleBot(Settings.TELEGRAM_BOT_TOKEN, num_threads=Settings.BOT_NUM_THREADS)
 
 # Регистрация обработчиков
 register_command_handlers(bot)
 register_message_handlers(bot)
 
+# Событие остановки, выставляется обработчиком SIGTERM/SIGINT
+shutdown_event = threading.Event()
+
+
+def _request_shutdown(signum, frame):
+    """Обработчик сигналов остановки"""
+    logger.info("Получен сигнал остановки (%s)", signal.Signals(signum).name)
+    shutdown_event.set()
+
+
+def _stop_update_workers(timeout: float) -> bool:
+    """
+    Дожидается, пока потоки telebot обработают полученные обновления, и останавливает их
+
+    На этапе остановки обработчики сохраняют сообщения в pending_turns, поэтому БД
+    нельзя закрывать, пока они работают.
+
+    Args:
+        timeout: Максимальное время ожидания в секундах
+
+    Returns:
+        True, если все потоки завершились
+    """
+    pool = getattr(bot, 'worker_pool', None)
+    if pool is None:
+        return True
+    deadline = time.monotonic() + timeout
+    while not pool.tasks.empty() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    for worker in pool.workers:
+        worker.stop()
+    for worker in pool.workers:
+        worker.join(max(deadline - time.monotonic(), 0))
+    return not any(worker.is_alive() for worker in pool.workers)
+
+
+def shutdown():
+    """
+    Корректно останавливает бота
+
+    Прекращает получение обновлений, дожидается обработки принятых сообщений
+    (не дольше SHUTDOWN_TIMEOUT), сохраняет незавершенные ходы для обработки после
+    перезапуска, завершает накопленную генерацию тезисов, записывает отложенные
+    изменения в БД и закрывает соединения.
+    """
+    logger.info("=" * 50)
+    logger.info("Остановка бота...")
+    logger.info("=" * 50)
+
+    deadline = time.monotonic() + Settings.SHUTDOWN_TIMEOUT
+    bot.stop_polling()
+    admission.stop_accepting()
+
+    if admission.drain(Settings.SHUTDOWN_TIMEOUT):
+        logger.info("Все принятые сообщения обработаны")
+    else:
+        saved = admission.checkpoint_remaining()
+        logger.warning("Не успели обработать до остановки: %d ходов сохранены для повторной обработки", saved)
+        # Ходы, которые уже сохраняют ответ и отвечают пользователю, не сохраняются повторно:
+        # даем им завершиться, пока соединения с БД открыты
+        if not admission.drain(Settings.SHUTDOWN_GRACE):
+            logger.warning("Часть ответов не успела завершиться до остановки")
+
+    # Потоки telebot могут еще сохранять сообщения, полученные во время остановки
+    if not _stop_update_workers(Settings.SHUTDOWN_GRACE):
+        logger.warning("Обработчики обновлений не завершились до остановки")
+
+    # Тезисы, не сгенерированные до остановки, будут обобщены после перезапуска (контрольная точка в БД)
+    if not thesis_scheduler.flush(max(deadline - time.monotonic(), 1)):
+        logger.warning("Генерация тезисов не завершена до остановки")
+
+    db_manager.flush(max(deadline - time.monotonic(), 1))
+    db_manager.close()
+
 
 def main():
     """Основная функция запуска бота"""
@@ -32,19 +110,31 @@ def main():
     logger.info(f"Время запуска: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     logger.info("=" * 50)
     
+    signal.signal(signal.SIGTERM, _request_shutdown)
+    signal.signal(signal.SIGINT, _request_shutdown)
+    
+    # Подключение к БД и миграции выполняются в фоне, не задерживая запуск polling
+    db_manager.start()
+    resume_pending_turns(bot)
+    start_thesis_idle_sweeper()
+    
     try:
         # Получаем информацию о боте
         bot_info = bot.get_me()
         logger.info(f"Бот успешно подключен: @{bot_info.username} (ID: {bot_info.id})")
         logger.info("Ожидание сообщений...")
         
-        bot.infinity_polling(none_stop=True, interval=0, timeout=20)
+        # Polling работает в отдельном потоке, основной поток ждет сигнала остановки
+        polling_thread = threading.Thread(
+            target=bot.infinity_polling,
+            kwargs={"none_stop": True, "interval": 0, "timeout": 20},
+            name="polling",
+            daemon=True
+        )
+        polling_thread.start()
+        while not shutdown_event.wait(1):
+            pass
         
-    except KeyboardInterrupt:
-        logger.info("=" * 50)
-        logger.info("Получен сигнал остановки (KeyboardInterrupt)")
-        logger.info("Остановка бота...")
-        logger.info("=" * 50)
     except Exception as e:
         error_traceback = traceback.format_exc()
         logger.critical(
@@ -53,7 +143,9 @@ def main():
         )
         logger.info("Бот остановлен из-за критической ошибки")
     finally:
+        shutdown()
         logger.info("Бот завершил работу")
+        stop_logging()
 
 
 if __name__ == '__main__':
@@ -2,42 +2,126 @@
 Модуль конфигурации логирования
 """
 import os
+import copy
+import json
+import queue
 import logging
-from logging.handlers import RotatingFileHandler
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
+# Контекст текущего запроса (user_id, request_id), подмешивается в каждую запись
+_log_context: contextvars.ContextVar = contextvars.ContextVar('log_context', default={})
 
-def setup_logging(log_dir: str = "logs") -> logging.Logger:
+# Фоновый слушатель очереди логов (только в асинхронном режиме)
+_queue_listener = None
+
+# Поля, которые передаются через extra и попадают в JSON-вывод
+_STRUCTURED_FIELDS = ('user_id', 'request_id', 'stage', 'timings')
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Привязывает поля к записям логов внутри блока
+
+    Args:
+        **fields: Поля контекста (например, user_id, request_id)
+    """
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Фильтр, добавляющий поля текущего контекста в запись лога"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматтер, выводящий записи логов одной строкой JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'location': f"{record.filename}:{record.lineno}",
+            'message': record.getMessage(),
+        }
+        for field in _STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """
+    QueueHandler, оставляющий форматирование обработчикам слушателя
+
+    Стандартный prepare() форматирует запись в вызывающем потоке и вставляет трассировку
+    исключения в текст сообщения, из-за чего JsonFormatter не видит exc_info.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы подставляются сразу: изменяемые объекты могут измениться до записи;
+        # exc_info сохраняется, и трассировку выводит форматтер каждого обработчика
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(log_dir: str = "logs", async_mode: bool = True, json_format: bool = False) -> logging.Logger:
     """
     Настраивает систему логирования
-    
+
+    В асинхронном режиме вызывающий поток только подставляет аргументы в сообщение
+    и кладет запись в очередь, а форматирование (включая трассировки исключений)
+    и запись в файлы выполняет фоновый QueueListener.
+
     Args:
         log_dir: Директория для хранения логов
-        
+        async_mode: Писать логи через очередь в фоновом потоке
+        json_format: Использовать структурированный JSON-формат в файлах логов
+
     Returns:
         Настроенный logger
     """
+    global _queue_listener
+
     # Создаем директорию для логов, если её нет
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
-    
+
     # Формат логов
     log_format = '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
     date_format = '%Y-%m-%d %H:%M:%S'
-    
-    # Настройка root logger
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    
+
+    # Настройка root logger, чтобы записи модулей (handlers.*, utils.*) попадали в обработчики
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+
     # Очищаем существующие обработчики
-    logger.handlers.clear()
-    
+    stop_logging()
+    root_logger.handlers.clear()
+
     # Обработчик для консоли
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
     console_formatter = logging.Formatter(log_format, date_format)
     console_handler.setFormatter(console_formatter)
-    logger.addHandler(console_handler)
-    
+
     # Обработчик для файла с ротацией (макс. 10MB, 5 файлов)
     file_handler = RotatingFileHandler(
         os.path.join(log_dir, 'bot.log'),
@@ -46,10 +130,12 @@ def setup_logging(log_dir: str = "logs") -> logging.Logger:
         encoding='utf-8'
     )
     file_handler.setLevel(logging.DEBUG)
-    file_formatter = logging.Formatter(log_format, date_format)
+    if json_format:
+        file_formatter = JsonFormatter(datefmt=date_format)
+    else:
+        file_formatter = logging.Formatter(log_format, date_format)
     file_handler.setFormatter(file_formatter)
-    logger.addHandler(file_handler)
-    
+
     # Обработчик для ошибок в отдельный файл
     error_handler = RotatingFileHandler(
         os.path.join(log_dir, 'errors.log'),
@@ -59,7 +145,29 @@ def setup_logging(log_dir: str = "logs") -> logging.Logger:
     )
     error_handler.setLevel(logging.ERROR)
     error_handler.setFormatter(file_formatter)
-    logger.addHandler(error_handler)
-    
-    return logger
 
+    handlers = [console_handler, file_handler, error_handler]
+    context_filter = ContextFilter()
+
+    if async_mode:
+        # Контекст снимается в потоке-источнике, до передачи записи в очередь
+        queue_handler = _QueueHandler(queue.SimpleQueue())
+        queue_handler.addFilter(context_filter)
+        root_logger.addHandler(queue_handler)
+        _queue_listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        _queue_listener.start()
+    else:
+        for handler in handlers:
+            handler.addFilter(context_filter)
+            root_logger.addHandler(handler)
+
+    return logging.getLogger(__name__)
+
+
+def stop_logging():
+    """Останавливает фоновый слушатель и дописывает оставшиеся в очереди записи"""
+    global _queue_listener
+
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
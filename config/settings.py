@@ -13,6 +13,7 @@ class Settings:
     
     # Telegram Bot Token
     TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+    BOT_NUM_THREADS = 2  # Потоков обработки обновлений telebot
     
     # OpenAI API Key для ProxyAPI
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
@@ -23,18 +24,73 @@ class Settings:
     # Модель для использования
     AI_MODEL = "gpt-4.1-mini-2025-04-14"
     
+    # Статичные инструкции модели: всегда идут первыми и не меняются между запросами,
+    # чтобы префикс промпта кэшировался на стороне провайдера
+    AI_SYSTEM_PROMPT = (
+        "Ты — дружелюбный AI-ассистент в Telegram. Отвечай по существу, на языке пользователя. "
+        "Учитывай контекст предыдущих разговоров и историю диалога, если они переданы."
+    )
+    
+    # Стоимость токенов модели за 1 млн (для учета расходов)
+    AI_PRICE_INPUT_PER_1M = float(os.getenv('AI_PRICE_INPUT_PER_1M') or 0.40)
+    AI_PRICE_CACHED_INPUT_PER_1M = float(os.getenv('AI_PRICE_CACHED_INPUT_PER_1M') or 0.10)
+    AI_PRICE_OUTPUT_PER_1M = float(os.getenv('AI_PRICE_OUTPUT_PER_1M') or 1.60)
+    
+    # ID администраторов, которым доступна команда /usage
+    ADMIN_IDS = {int(x) for x in (os.getenv('ADMIN_IDS') or '').split(',') if x.strip()}
+    
     # Настройки логирования
     LOG_DIR = "logs"
+    LOG_ASYNC = (os.getenv('LOG_ASYNC') or 'true').lower() == 'true'  # Запись логов через очередь в фоновом потоке
+    LOG_JSON = (os.getenv('LOG_JSON') or 'false').lower() == 'true'  # Структурированный JSON в файлах логов
     
     # Настройки памяти диалогов
     MAX_MESSAGES_HISTORY = 10  # Максимальное количество сообщений пользователя в истории
     
+    # Контроль допуска запросов к AI при перегрузке
+    ADMISSION_MAX_INFLIGHT = int(os.getenv('ADMISSION_MAX_INFLIGHT') or 4)  # Одновременных запросов к модели
+    ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE') or 100)  # Максимальная длина очереди
+    ADMISSION_MAX_PER_USER = int(os.getenv('ADMISSION_MAX_PER_USER') or 3)  # Сообщений одного пользователя в очереди
+    ADMISSION_MAX_WAIT = int(os.getenv('ADMISSION_MAX_WAIT') or 60)  # Максимальное ожидание в очереди, сек
+    
+    # Генерация тезисов: 'volume' — по объему необобщенных сообщений и паузе, 'every_n' — каждые 3 сообщения
+    THESIS_TRIGGER = os.getenv('THESIS_TRIGGER') or 'volume'
+    THESIS_TOKEN_THRESHOLD = int(os.getenv('THESIS_TOKEN_THRESHOLD') or 600)  # Порог объема, токенов
+    THESIS_IDLE_SECONDS = int(os.getenv('THESIS_IDLE_SECONDS') or 900)  # Пауза, после которой обобщается остаток, сек
+    THESIS_MIN_IDLE_TOKENS = 40  # Минимальный объем для генерации тезисов по паузе, токенов
+    THESIS_IDLE_CHECK_INTERVAL = 60  # Период проверки пауз, сек
+    THESIS_MAX_INPUT_CHARS = 12000  # Максимум символов сообщений одного пользователя для генерации тезисов
+    THESIS_BATCH_WINDOW = float(os.getenv('THESIS_BATCH_WINDOW') or 5)  # Окно накопления пакета пользователей, сек
+    THESIS_BATCH_MAX_USERS = int(os.getenv('THESIS_BATCH_MAX_USERS') or 20)  # Максимум пользователей в пакете
+    THESIS_BATCH_MAX_CHARS = 24000  # Максимум символов сообщений в одном пакетном запросе
+    THESIS_BATCH_CONCURRENCY = int(os.getenv('THESIS_BATCH_CONCURRENCY') or 2)  # Одновременных запросов генерации тезисов
+    
+    # Время на завершение принятых сообщений при остановке (SIGTERM/SIGINT), сек
+    SHUTDOWN_TIMEOUT = int(os.getenv('SHUTDOWN_TIMEOUT') or 20)
+    SHUTDOWN_GRACE = 5  # Дополнительное ожидание фиксируемых ходов и потоков telebot после таймаута, сек
+    
+    # Настройки кэша ответов (только для запросов без истории и тезисов)
+    RESPONSE_CACHE_ENABLED = (os.getenv('RESPONSE_CACHE_ENABLED') or 'false').lower() == 'true'
+    RESPONSE_CACHE_PERSIST = (os.getenv('RESPONSE_CACHE_PERSIST') or 'false').lower() == 'true'  # Хранить кэш в PostgreSQL
+    RESPONSE_CACHE_MAX_SIZE = int(os.getenv('RESPONSE_CACHE_MAX_SIZE') or 1000)  # Максимум записей в памяти
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL') or 86400)  # Время жизни записи, сек
+    RESPONSE_CACHE_DB_MAX_ROWS = int(os.getenv('RESPONSE_CACHE_DB_MAX_ROWS') or 10000)  # Максимум записей в PostgreSQL
+    RESPONSE_CACHE_NEAR_MATCH = (os.getenv('RESPONSE_CACHE_NEAR_MATCH') or 'false').lower() == 'true'  # Похожие запросы (опечатки)
+    RESPONSE_CACHE_NEAR_THRESHOLD = float(os.getenv('RESPONSE_CACHE_NEAR_THRESHOLD') or 0.9)  # Порог сходства запросов
+    RESPONSE_CACHE_STATS_EVERY = 100  # Выводить статистику кэша каждые N запросов
+    
     # Настройки PostgreSQL
     DB_HOST = os.getenv('DB_HOST') or '85.198.103.173'
     DB_PORT = os.getenv('DB_PORT') or '5432'
     DB_NAME = os.getenv('DB_NAME') or 'memorybot'
     DB_USER = os.getenv('DB_USER') or 'postgres'
     DB_PASSWORD = os.getenv('DB_PASSWORD')
+    DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT') or 5)  # Таймаут подключения, сек
+    DB_POOL_MIN = int(os.getenv('DB_POOL_MIN') or 1)  # Минимум соединений в пуле
+    DB_POOL_MAX = int(os.getenv('DB_POOL_MAX') or 10)  # Максимум соединений в пуле
+    DB_POOL_WAIT_TIMEOUT = 10  # Ожидание свободного соединения, сек
+    DB_INIT_RETRY_DELAY = 3  # Базовая пауза между попытками подключения при старте, сек
+    DB_PENDING_WRITES_LIMIT = 1000  # Максимум записей, ожидающих готовности БД
 
     @classmethod
     def validate(cls):
@@ -53,3 +109,12 @@ class Settings:
         if not cls.DB_PASSWORD:
             raise ValueError("DB_PASSWORD не установлен")
 
+        # Каждый поток, работающий с БД, одновременно держит не больше одного соединения:
+        # обработчики telebot, пул контроля допуска, запросы тезисов (запись расхода) и поток планировщика
+        db_threads = cls.BOT_NUM_THREADS + cls.ADMISSION_MAX_INFLIGHT + cls.THESIS_BATCH_CONCURRENCY + 1
+        if cls.DB_POOL_MAX < db_threads:
+            raise ValueError(
+                f"DB_POOL_MAX ({cls.DB_POOL_MAX}) меньше числа потоков, работающих с БД ({db_threads}): "
+                f"увеличьте DB_POOL_MAX или уменьшите ADMISSION_MAX_INFLIGHT/THESIS_BATCH_CONCURRENCY"
+            )
+
@@ -5,13 +5,12 @@ import logging
 from telebot import TeleBot
 from utils.messages import Messages
 from utils.memory_manager import memory
-from utils.db_manager import DBManager
+from utils.database import db_manager
+from handlers.messages import thesis_policy
+from config.settings import Settings
 
 logger = logging.getLogger(__name__)
 
-# Инициализируем менеджер БД
-db_manager = DBManager()
-
 
 def register_command_handlers(bot: TeleBot):
     """
@@ -54,8 +53,27 @@ def register_command_handlers(bot: TeleBot):
         memory.clear_history(user_id)
         # Очищаем базу данных
         db_manager.clear_all_history(user_id)
+        thesis_policy.forget(user_id)
         
         bot.reply_to(message, Messages.HISTORY_CLEARED)
         
         logger.debug(f"История диалога пользователя {user_id} полностью очищена")
-
+    
+    @bot.message_handler(commands=['usage'], func=lambda message: message.from_user.id in Settings.ADMIN_IDS)
+    def show_usage(message):
+        """Обработчик команды /usage - расход токенов и доля кэшированного промпта (для администраторов)"""
+        user_id = message.from_user.id
+        logger.info(f"Команда /usage от администратора ID: {user_id}")
+        
+        by_day = db_manager.get_usage_by_day(7)
+        by_user = db_manager.get_usage_by_user(7, 10)
+        if not by_day:
+            bot.reply_to(message, Messages.USAGE_NO_DATA)
+            return
+        
+        lines = [Messages.USAGE_DAYS_HEADER]
+        lines.extend(Messages.USAGE_ROW.format(**row) for row in by_day)
+        lines.append("")
+        lines.append(Messages.USAGE_USERS_HEADER)
+        lines.extend(Messages.USAGE_ROW.format(**row) for row in by_user)
+        bot.reply_to(message, "\n".join(lines))
@@ -1,22 +1,56 @@
 """
 Обработчики текстовых сообщений бота
 """
+import json
 import time
-import traceback
+import uuid
 import logging
-from telebot import TeleBot
+import threading
+from telebot import TeleBot, types
+from config.logging_config import log_context
 from utils.ai_client import AIClient
 from utils.messages import Messages
 from utils.memory_manager import memory
-from utils.db_manager import DBManager
+from utils.database import db_manager
+from utils.response_cache import ResponseCache
+from utils.admission import AdmissionController
+from utils.thesis_trigger import create_policy
+from utils.thesis_scheduler import ThesisScheduler
+from config.settings import Settings
 
 logger = logging.getLogger(__name__)
 
+# Инициализируем кэш ответов для запросов без персонального контекста (опционально)
+response_cache = None
+if Settings.RESPONSE_CACHE_ENABLED:
+    response_cache = ResponseCache(
+        max_size=Settings.RESPONSE_CACHE_MAX_SIZE,
+        ttl=Settings.RESPONSE_CACHE_TTL,
+        near_threshold=Settings.RESPONSE_CACHE_NEAR_THRESHOLD,
+        near_match=Settings.RESPONSE_CACHE_NEAR_MATCH,
+        store=db_manager if Settings.RESPONSE_CACHE_PERSIST else None,
+        store_max_rows=Settings.RESPONSE_CACHE_DB_MAX_ROWS
+    )
+
 # Инициализируем AI клиент
-ai_client = AIClient()
+ai_client = AIClient(cache=response_cache, usage_recorder=db_manager.save_usage)
+
+# Политика запуска генерации тезисов; после перезапуска объем восстанавливается по БД
+thesis_policy = create_policy(
+    Settings.THESIS_TRIGGER,
+    loader=lambda user_id: [content for _, content in db_manager.get_unsummarized_messages(user_id)],
+    token_threshold=Settings.THESIS_TOKEN_THRESHOLD,
+    idle_seconds=Settings.THESIS_IDLE_SECONDS,
+    min_idle_tokens=Settings.THESIS_MIN_IDLE_TOKENS
+)
 
-# Инициализируем менеджер БД
-db_manager = DBManager()
+# Контроль допуска: ограничивает одновременные запросы к модели и длину очереди
+admission = AdmissionController(
+    max_inflight=Settings.ADMISSION_MAX_INFLIGHT,
+    max_queue=Settings.ADMISSION_MAX_QUEUE,
+    max_per_user=Settings.ADMISSION_MAX_PER_USER,
+    max_wait=Settings.ADMISSION_MAX_WAIT
+)
 
 
 def register_message_handlers(bot: TeleBot):
@@ -30,64 +64,263 @@ def register_message_handlers(bot: TeleBot):
     @bot.message_handler(func=lambda message: True)
     def handle_message(message):
         """Обработчик всех текстовых сообщений"""
-        start_time = time.time()
-        
-        user = message.from_user
-        user_id = user.id
-        user_info = f"ID: {user_id}, Username: @{user.username or 'N/A'}, Имя: {user.first_name or 'N/A'}"
-        user_message = message.text
-        chat_id = message.chat.id
-        
-        logger.info(
-            f"Получено сообщение от пользователя {user_info}. "
-            f"Chat ID: {chat_id}, Длина сообщения: {len(user_message)} символов"
+        if not admission.accepting:
+            # Идет остановка. Обновление уже подтверждено в Telegram (telebot запрашивает следующую порцию
+            # со сдвинутым offset сразу после получения), поэтому сохраняем ход для обработки после перезапуска
+            logger.info("Бот останавливается, сообщение пользователя %s будет обработано после перезапуска",
+                        message.from_user.id)
+            db_manager.save_pending_turn(
+                message.from_user.id, json.dumps(message.json, ensure_ascii=False), False
+            )
+            return
+        _submit_message(bot, message)
+
+
+def _submit_message(bot: TeleBot, message, user_saved: bool = False):
+    """
+    Передает сообщение в контроль допуска
+
+    Args:
+        bot: Экземпляр TeleBot
+        message: Входящее сообщение
+        user_saved: Сообщение пользователя уже сохранено в БД (ход восстановлен после перезапуска)
+    """
+    user_id = message.from_user.id
+    request_id = uuid.uuid4().hex[:12]
+    # Блокировка согласует фиксацию хода обработчиком и его сохранение при остановке:
+    # выполняется только одно из двух
+    state = {'user_saved': user_saved, 'checkpointed': False, 'committing': False, 'lock': threading.Lock()}
+
+    def run():
+        with log_context(user_id=user_id, request_id=request_id):
+            _handle_message(bot, message, state)
+
+    def reject():
+        with log_context(user_id=user_id, request_id=request_id):
+            _reply_busy(bot, message)
+
+    def checkpoint() -> bool:
+        with state['lock']:
+            if state['committing']:
+                # Ответ уже сохраняется и отправляется: повторная обработка создала бы дубликат
+                return False
+            state['checkpointed'] = True
+            user_saved = state['user_saved']
+        db_manager.save_pending_turn(user_id, json.dumps(message.json, ensure_ascii=False), user_saved)
+        return True
+
+    # Обработка выполняется пулом контроля допуска; при переполнении сразу отвечаем отказом
+    if not admission.submit(user_id, run, on_expired=reject, checkpoint=checkpoint):
+        reject()
+
+
+def resume_pending_turns(bot: TeleBot):
+    """
+    Запускает в фоне повторную обработку ходов, не завершенных до предыдущей остановки
+
+    Args:
+        bot: Экземпляр TeleBot
+    """
+    def worker():
+        db_manager.wait_ready()
+        turns = db_manager.take_pending_turns()
+        if turns:
+            logger.info("Восстановление %d незавершенных ходов после перезапуска", len(turns))
+        for user_id, payload, user_saved in turns:
+            try:
+                message = types.Message.de_json(payload)
+                _submit_message(bot, message, user_saved=user_saved)
+            except Exception as e:
+                logger.error("Не удалось восстановить ход пользователя %s: %s", user_id, e)
+
+    threading.Thread(target=worker, name="resume-turns", daemon=True).start()
+
+
+def _prepare_thesis_job(user_id: int):
+    """
+    Подготавливает задачу генерации тезисов: сообщения пользователя после контрольной точки
+
+    Сообщения берутся от старых к новым в пределах THESIS_MAX_INPUT_CHARS; если все не поместились,
+    контрольная точка сдвигается только до последнего взятого сообщения, а остаток
+    обобщается следующей задачей.
+
+    Args:
+        user_id: ID пользователя
+
+    Returns:
+        (ID последнего обобщаемого сообщения, тексты без тривиальных, остались ли сообщения) или None,
+        если обобщать нечего
+    """
+    if not db_manager.is_ready():
+        return None
+    rows = db_manager.get_unsummarized_messages(user_id)
+    if not rows:
+        thesis_policy.mark_summarized(user_id)
+        return None
+
+    # Тривиальные сообщения пропускаем, но контрольную точку сдвигаем и через них
+    selected, total_chars, skipped, last_message_id = [], 0, 0, rows[0][0]
+    for message_id, content in rows:
+        if thesis_policy.is_trivial(content):
+            skipped += 1
+        else:
+            if selected and total_chars + len(content) > Settings.THESIS_MAX_INPUT_CHARS:
+                break
+            selected.append(content[:Settings.THESIS_MAX_INPUT_CHARS])
+            total_chars += len(content)
+        last_message_id = message_id
+    has_more = last_message_id != rows[-1][0]
+
+    logger.debug(
+        "Тезисы пользователя %s: к обобщению %d сообщений (%d тривиальных пропущено%s)",
+        user_id, len(selected), skipped, ", остаток — следующей задачей" if has_more else ""
+    )
+    return last_message_id, selected, has_more
+
+
+# Планировщик пакетной генерации тезисов: задачи разных пользователей объединяются в общие запросы
+thesis_scheduler = ThesisScheduler(
+    prepare=_prepare_thesis_job,
+    generate_batch=ai_client.generate_theses_batch,
+    generate_single=lambda texts, user_id: ai_client.generate_theses(texts, user_id=user_id),
+    save_bulk=db_manager.save_theses_bulk,
+    on_saved=thesis_policy.mark_summarized,
+    window=Settings.THESIS_BATCH_WINDOW,
+    max_users=Settings.THESIS_BATCH_MAX_USERS,
+    max_chars=Settings.THESIS_BATCH_MAX_CHARS,
+    concurrency=Settings.THESIS_BATCH_CONCURRENCY
+)
+
+
+def start_thesis_idle_sweeper():
+    """Запускает фоновую проверку пауз: накопленные сообщения обобщаются, когда пользователь замолчал"""
+    def worker():
+        while True:
+            time.sleep(Settings.THESIS_IDLE_CHECK_INTERVAL)
+            for user_id in thesis_policy.due_idle():
+                thesis_scheduler.submit(user_id)
+
+    threading.Thread(target=worker, name="thesis-idle", daemon=True).start()
+
+
+def _reply_busy(bot: TeleBot, message):
+    """Быстро сообщает пользователю о перегрузке вместо позднего ответа"""
+    try:
+        bot.reply_to(message, Messages.BUSY)
+    except Exception as e:
+        logger.warning("Не удалось отправить сообщение о перегрузке: %s", e)
+
+
+def _begin_commit(state: dict) -> bool:
+    """
+    Отмечает начало фиксации хода (сохранение ответа и отправка пользователю)
+
+    Returns:
+        False, если ход уже сохранен при остановке и фиксировать его нельзя
+    """
+    with state['lock']:
+        if state['checkpointed']:
+            return False
+        state['committing'] = True
+        return True
+
+
+def _handle_message(bot: TeleBot, message, state: dict):
+    """
+    Обрабатывает текстовое сообщение и замеряет длительность этапов
+
+    Args:
+        bot: Экземпляр TeleBot
+        message: Входящее сообщение
+        state: Состояние хода: user_saved (сообщение уже в БД), checkpointed (ход сохранен при остановке),
+            committing (начата фиксация ответа), lock (блокировка user_saved/checkpointed/committing)
+    """
+    start_time = time.time()
+    timings = {}
+
+    user = message.from_user
+    user_id = user.id
+    user_message = message.text
+    chat_id = message.chat.id
+
+    logger.info(
+        "Получено сообщение от пользователя ID: %s, Username: @%s, Имя: %s. "
+        "Chat ID: %s, Длина сообщения: %d символов",
+        user_id, user.username or 'N/A', user.first_name or 'N/A', chat_id, len(user_message)
+    )
+
+    # Отправляем индикатор печати
+    try:
+        bot.send_chat_action(chat_id, 'typing')
+    except Exception as e:
+        logger.warning("Не удалось отправить индикатор печати: %s", e)
+
+    stage_start = time.time()
+
+    def mark(stage: str):
+        """Фиксирует длительность завершившегося этапа"""
+        nonlocal stage_start
+        now = time.time()
+        timings[stage] = round(now - stage_start, 4)
+        stage_start = now
+
+    try:
+        # 1. Сохраняем сообщение пользователя в БД (под блокировкой: контрольная точка
+        # должна знать, сохранено ли сообщение, иначе после перезапуска оно задублируется)
+        with state['lock']:
+            if state['checkpointed']:
+                logger.info("Ход сохранен при остановке до начала обработки")
+                return
+            if not state['user_saved']:
+                db_manager.save_message(user_id, 'user', user_message)
+                state['user_saved'] = True
+        mark('save_user_message')
+
+        # 2. Загружаем накопленные тезисы (Long-term context)
+        system_context = db_manager.get_theses(user_id)
+
+        # 3. Получаем короткую историю (Short-term context)
+        history = memory.get_history(user_id)
+        mark('load_context')
+
+        # 4. Получаем ответ от AI с учетом тезисов и истории
+        ai_response = ai_client.get_response(
+            user_message, history=history, system_context=system_context, user_id=user_id
         )
-        
-        # Отправляем индикатор печати
-        try:
-            bot.send_chat_action(chat_id, 'typing')
-        except Exception as e:
-            logger.warning(f"Не удалось отправить индикатор печати: {e}")
-        
-        try:
-            # 1. Сохраняем сообщение пользователя в БД
-            db_manager.save_message(user_id, 'user', user_message)
-
-            # 2. Загружаем накопленные тезисы (Long-term context)
-            system_context = db_manager.get_theses(user_id)
-
-            # 3. Получаем короткую историю (Short-term context)
-            history = memory.get_history(user_id)
-            
-            # 4. Получаем ответ от AI с учетом тезисов и истории
-            ai_response = ai_client.get_response(user_message, history=history, system_context=system_context)
-            
-            if not ai_response:
-                ai_response = Messages.ERROR_AI_RESPONSE
-            
-            # 5. Сохраняем ответ в оперативную память и в БД
-            memory.add_user_message(user_id, user_message)
-            memory.add_assistant_message(user_id, ai_response)
-            db_manager.save_message(user_id, 'assistant', ai_response)
-            
-            # 6. Проверяем, нужно ли обновить тезисы (каждые 3 сообщения пользователя)
-            user_msg_count = db_manager.get_user_messages_count(user_id)
-            if user_msg_count > 0 and user_msg_count % 3 == 0:
-                logger.info(f"Запуск генерации тезисов для пользователя {user_id}...")
-                recent_msgs = db_manager.get_recent_user_messages(user_id, 3)
-                new_theses = ai_client.generate_theses(recent_msgs)
-                if new_theses:
-                    db_manager.save_thesis(user_id, new_theses)
-                    logger.info(f"Тезисы успешно обновлены для {user_id}")
-
-            # 7. Отправляем ответ пользователю
-            bot.reply_to(message, ai_response)
-            
-            elapsed_time = time.time() - start_time
-            logger.info(f"Ответ отправлен за {elapsed_time:.2f}с")
-            
-        except Exception as e:
-            elapsed_time = time.time() - start_time
-            logger.error(f"Ошибка при обработке сообщения: {e}")
-            bot.reply_to(message, Messages.ERROR_GENERAL)
+        mark('llm')
 
+        if not ai_response:
+            ai_response = Messages.ERROR_AI_RESPONSE
+
+        if not _begin_commit(state):
+            # Ход уже сохранен для повторной обработки после перезапуска: не дублируем ответ
+            logger.info("Ход сохранен при остановке, ответ будет отправлен после перезапуска")
+            return
+
+        # 5. Сохраняем ответ в оперативную память и в БД
+        memory.add_user_message(user_id, user_message)
+        memory.add_assistant_message(user_id, ai_response)
+        db_manager.save_message(user_id, 'assistant', ai_response)
+        mark('save_response')
+
+        # 6. Проверяем по политике, пора ли обобщить накопленные сообщения в тезисы
+        if thesis_policy.observe(user_id, user_message):
+            logger.info("Пользователь %s поставлен в очередь генерации тезисов", user_id)
+            thesis_scheduler.submit(user_id)
+        mark('theses')
+
+        # 7. Отправляем ответ пользователю
+        bot.reply_to(message, ai_response)
+        mark('reply')
+
+        elapsed_time = time.time() - start_time
+        logger.info("Ответ отправлен за %.2fс", elapsed_time, extra={'timings': timings})
+
+    except Exception as e:
+        elapsed_time = time.time() - start_time
+        logger.error(
+            "Ошибка при обработке сообщения (время выполнения: %.2fс): %s",
+            elapsed_time, e, extra={'timings': timings}
+        )
+        if state['committing'] or _begin_commit(state):
+            bot.reply_to(message, Messages.ERROR_GENERAL)
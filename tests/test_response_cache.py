@@ -0,0 +1,94 @@
+"""
+Тесты кэша ответов: почти совпадающие запросы не должны подменять ответы на запросы с другим смыслом
+"""
+import unittest
+
+from utils.response_cache import ResponseCache, is_typo_variant, normalize_text
+
+MODEL = "gpt-test"
+SYSTEM = {"role": "system", "content": "Ты полезный ассистент."}
+
+TRAVEL_EUROPE = (
+    "I am planning a three week trip this summer with my family and two small kids. "
+    "Which countries in Europe would you recommend for a relaxed holiday with good food? "
+    "We prefer quiet places near the sea, short transfers between cities and hotels with a pool."
+)
+TRAVEL_ASIA = TRAVEL_EUROPE.replace("Europe", "Asia")
+
+NAME_ALEXANDER = (
+    "Привет! Меня зовут Александр, я работаю бухгалтером в небольшой компании и хочу сменить профессию. "
+    "Подскажи, с чего начать изучение программирования взрослому человеку без технического образования? "
+    "Могу заниматься по вечерам пару часов, хочу понять, какие курсы и книги выбрать в первую очередь."
+)
+NAME_MAXIM = NAME_ALEXANDER.replace("Александр", "Максим")
+
+
+def _messages(text: str) -> list:
+    return [SYSTEM, {"role": "user", "content": text}]
+
+
+class ResponseCacheNearMatchTest(unittest.TestCase):
+    """Поиск почти совпадающих запросов"""
+
+    def setUp(self):
+        self.cache = ResponseCache(near_match=True)
+
+    def _assert_similar(self, first: str, second: str):
+        """Запросы проходят порог MinHash: промах обеспечивает именно проверка опечаток"""
+        signatures = [self.cache._signature(normalize_text(text)) for text in (first, second)]
+        self.assertGreaterEqual(self.cache._similarity(*signatures), self.cache.near_threshold)
+
+    def _put(self, text: str, response: str):
+        self.cache.put(MODEL, _messages(text), response, latency=1.0)
+
+    def test_typo_is_near_hit(self):
+        self._put(TRAVEL_EUROPE, "europe answer")
+        typo = TRAVEL_EUROPE.replace("recommend", "recomend")
+        self.assertEqual(self.cache.get(MODEL, _messages(typo)), "europe answer")
+        self.assertEqual(self.cache.get_stats()["near_hits"], 1)
+
+    def test_swapped_entity_is_miss(self):
+        self._put(TRAVEL_EUROPE, "europe answer")
+        self._assert_similar(TRAVEL_EUROPE, TRAVEL_ASIA)
+        self.assertIsNone(self.cache.get(MODEL, _messages(TRAVEL_ASIA)))
+
+    def test_swapped_name_is_miss(self):
+        self._put(NAME_ALEXANDER, "ответ для Александра")
+        self._assert_similar(NAME_ALEXANDER, NAME_MAXIM)
+        self.assertIsNone(self.cache.get(MODEL, _messages(NAME_MAXIM)))
+
+    def test_negation_is_miss(self):
+        self._put(NAME_ALEXANDER, "ответ")
+        negated = NAME_ALEXANDER.replace("хочу сменить", "не хочу сменить")
+        self._assert_similar(NAME_ALEXANDER, negated)
+        self.assertIsNone(self.cache.get(MODEL, _messages(negated)))
+
+    def test_changed_number_is_miss(self):
+        self._put(TRAVEL_EUROPE, "europe answer")
+        changed = TRAVEL_EUROPE.replace("three week", "3 week")
+        self._assert_similar(TRAVEL_EUROPE, changed)
+        self.assertIsNone(self.cache.get(MODEL, _messages(changed)))
+
+    def test_disabled_by_default(self):
+        cache = ResponseCache()
+        cache.put(MODEL, _messages(TRAVEL_EUROPE), "europe answer", latency=1.0)
+        typo = TRAVEL_EUROPE.replace("recommend", "recomend")
+        self.assertIsNone(cache.get(MODEL, _messages(typo)))
+        self.assertEqual(cache.get(MODEL, _messages(TRAVEL_EUROPE)), "europe answer")
+
+
+class TypoVariantTest(unittest.TestCase):
+    """Сравнение запросов по словам"""
+
+    def test_transposition_is_typo(self):
+        self.assertTrue(is_typo_variant(("what", "is", "python"), ("waht", "is", "python")))
+
+    def test_short_word_change_is_not_typo(self):
+        self.assertFalse(is_typo_variant(("это", "не", "так"), ("это", "на", "так")))
+
+    def test_digits_must_match(self):
+        self.assertFalse(is_typo_variant(("year", "2024"), ("year", "2025")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,484 @@
+"""
+Офлайн-воспроизведение диалогов и профилирование
+
+Прогоняет трассу диалогов через настоящие handle_message / AIClient / DBManager /
+ConversationMemory с заглушками Telegram и модели. Трасса — JSONL со строками
+{"user_id": ..., "text": ..., "reply": ...} (reply необязателен: это ответ заглушки модели).
+
+Запуск (против локальной БД из .env):
+    python -m tools.replay --synthesize --users 50 --turns 20 --profile --tracemalloc
+    python -m tools.replay --from-db --limit 2000 --export trace.jsonl
+    python -m tools.replay --trace trace.jsonl --report replay_report.txt
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import pstats
+import re
+import cProfile
+import logging
+import argparse
+import threading
+import tracemalloc
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
+# Ключ API не используется (модель заглушена), но нужен для создания клиента
+os.environ.setdefault("OPENAI_API_KEY", "replay")
+
+from telebot import types  # noqa: E402
+
+from config.settings import Settings  # noqa: E402
+from utils.messages import Messages  # noqa: E402
+from utils.database import db_manager  # noqa: E402
+from utils.response_cache import normalize_text  # noqa: E402
+
+logger = logging.getLogger("tools.replay")
+
+# Методы DBManager, для которых считаются вызовы и время
+DB_METHODS = [
+    "save_message", "get_theses", "get_user_messages_count", "get_unsummarized_messages",
+    "save_theses_bulk", "save_usage", "get_cached_response", "save_cached_response",
+]
+
+# Смещение ID пользователей, чтобы воспроизведение не смешивалось с реальными диалогами
+DEFAULT_USER_OFFSET = 9_000_000_000
+
+# Хосты, которые считаются локальными: воспроизведение пишет в БД, поэтому по умолчанию только они
+LOCAL_DB_HOSTS = {"localhost", "127.0.0.1", "::1", "postgres", "db"}
+
+_WORDS = (
+    "бот память контекст тезис история вопрос ответ модель запрос пользователь python "
+    "postgres telegram docker сервер настройка ошибка лог кэш время данные проект задача"
+).split()
+
+
+# ---------------------------------------------------------------------------
+# Трасса
+# ---------------------------------------------------------------------------
+
+def load_trace(path: str) -> list:
+    """Загружает трассу из JSONL-файла"""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_trace(trace: list, path: str):
+    """Сохраняет трассу в JSONL-файл"""
+    with open(path, "w", encoding="utf-8") as f:
+        for turn in trace:
+            f.write(json.dumps(turn, ensure_ascii=False) + "\n")
+
+
+def trace_from_db(limit: int, user_id: int = None) -> list:
+    """Строит трассу из таблицы messages: сообщение пользователя и следующий за ним ответ"""
+    if not db_manager.wait_ready(30):
+        raise RuntimeError("БД недоступна, выгрузка трассы невозможна")
+    trace = []
+    last_turn = {}
+    for uid, role, content in db_manager.export_messages(limit, user_id):
+        if role == "user":
+            last_turn[uid] = {"user_id": uid, "text": content}
+            trace.append(last_turn[uid])
+        elif role == "assistant" and uid in last_turn:
+            last_turn.pop(uid)["reply"] = content
+    return trace
+
+
+def synthesize_trace(users: int, turns: int, seed: int) -> list:
+    """Генерирует трассу со случайными сообщениями разной длины, перемешанными между пользователями"""
+    rng = random.Random(seed)
+    per_user = [
+        [
+            {"user_id": uid, "text": " ".join(rng.choices(_WORDS, k=rng.choice((1, 3, 12, 60, 300))))}
+            for _ in range(turns)
+        ]
+        for uid in range(1, users + 1)
+    ]
+    trace = []
+    while any(per_user):
+        queue = rng.choice([q for q in per_user if q])
+        trace.append(queue.pop(0))
+    return trace
+
+
+# ---------------------------------------------------------------------------
+# Заглушки Telegram и модели
+# ---------------------------------------------------------------------------
+
+class FakeBot:
+    """Заглушка TeleBot: регистрирует обработчики и записывает ответы"""
+
+    def __init__(self):
+        self.handlers = []
+        self.replies = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def message_handler(self, **kwargs):
+        def decorator(handler):
+            self.handlers.append(handler)
+            return handler
+        return decorator
+
+    def send_chat_action(self, chat_id, action):
+        pass
+
+    def reply_to(self, message, text):
+        with self._lock:
+            self.replies[message.from_user.id].append(text)
+
+
+class FakeCompletions:
+    """Заглушка chat.completions: ответ из трассы (или синтетический) с заданной задержкой"""
+
+    def __init__(self, replies: dict, latency: float):
+        self.replies = replies
+        self.latency = latency
+        self.calls = defaultdict(int)
+
+    def create(self, model, messages, response_format=None):
+        if self.latency:
+            time.sleep(self.latency)
+        # Ответы на сообщения начинаются со статичного системного промпта, генерация тезисов — нет
+        if messages[0]["role"] == "system":
+            kind = "reply"
+            text = messages[-1]["content"]
+            content = self.replies.get(text) or f"Ответ на: {text[:80]}"
+        elif response_format is not None:
+            # Пакетная генерация тезисов: JSON с тезисами для каждого номера пользователя из запроса
+            kind = "theses_batch"
+            numbers = re.findall(r'"(\d+)": \[', messages[0]["content"])
+            content = json.dumps({number: "тезис о пользователе; интерес к теме" for number in numbers})
+        else:
+            kind = "theses"
+            content = "тезис о пользователе; интерес к теме"
+        self.calls[kind] += 1
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=len(content) // 4,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=0)
+        )
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+
+def make_message(message_id: int, user_id: int, text: str):
+    """Создает объект сообщения Telegram"""
+    return types.Message.de_json({
+        "message_id": message_id,
+        "from": {"id": user_id, "is_bot": False, "first_name": "Replay"},
+        "chat": {"id": user_id, "type": "private"},
+        "date": int(time.time()),
+        "text": text,
+    })
+
+
+# ---------------------------------------------------------------------------
+# Инструментирование
+# ---------------------------------------------------------------------------
+
+class StageCollector(logging.Handler):
+    """Собирает время этапов из структурированных логов обработчика (поле timings)"""
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.stages = defaultdict(list)
+
+    def emit(self, record):
+        timings = getattr(record, "timings", None)
+        if timings:
+            for stage, value in timings.items():
+                self.stages[stage].append(value)
+
+
+class DBCallCounter:
+    """Считает вызовы и время методов DBManager"""
+
+    def __init__(self, manager, methods):
+        self.calls = defaultdict(int)
+        self.time = defaultdict(float)
+        self._lock = threading.Lock()
+        for name in methods:
+            setattr(manager, name, self._wrap(name, getattr(manager, name)))
+
+    def _wrap(self, name, method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.calls[name] += 1
+                    self.time[name] += time.perf_counter() - start
+        return wrapper
+
+
+class ThreadProfiler:
+    """cProfile для всех потоков, запущенных после start() (включая пул контроля допуска)"""
+
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def _bootstrap(self, frame, event, arg):
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        main_profile = cProfile.Profile()
+        self.profiles.append(main_profile)
+        threading.setprofile(self._bootstrap)
+        main_profile.enable()
+
+    def stop(self):
+        threading.setprofile(None)
+        self.profiles[0].disable()
+
+    def report(self, top: int) -> str:
+        out = io.StringIO()
+        stats = pstats.Stats(self.profiles[0], stream=out)
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats("cumulative").print_stats(top)
+        out.write("\n")
+        stats.sort_stats("tottime").print_stats(top)
+        return out.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# Воспроизведение
+# ---------------------------------------------------------------------------
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def replay(trace: list, args) -> str:
+    """Прогоняет трассу и возвращает текст отчета"""
+    db_counter = DBCallCounter(db_manager, DB_METHODS)
+
+    # Импорт после инструментирования БД, чтобы учитывались и ссылки, сохраненные при импорте
+    from handlers import messages as message_handlers
+    from handlers.messages import register_message_handlers
+    from utils.memory_manager import memory
+
+    replies = {turn["text"]: turn["reply"] for turn in trace if turn.get("reply")}
+    completions = FakeCompletions(replies, args.model_latency)
+    message_handlers.ai_client.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    bot = FakeBot()
+    register_message_handlers(bot)
+    handle_message = bot.handlers[-1]
+
+    stage_collector = StageCollector()
+    logging.getLogger().addHandler(stage_collector)
+
+    db_ready = db_manager.wait_ready(args.db_timeout)
+    if not db_ready:
+        logger.warning("БД не готова: записи будут отложены, проверки БД пропущены")
+
+    profiler = ThreadProfiler() if args.profile else None
+    if args.tracemalloc:
+        tracemalloc.start(25)
+    if profiler:
+        profiler.start()
+
+    # Эталонная модель короткой памяти: последние MAX_MESSAGES_HISTORY пар (сообщение, ответ)
+    expected = defaultdict(lambda: deque(maxlen=Settings.MAX_MESSAGES_HISTORY))
+    # Сообщение пользователя сохраняется в БД для каждого принятого хода, в том числе завершившегося ошибкой
+    saved_messages = defaultdict(int)
+    memory_errors = []
+
+    replay_started_at = time.time()
+    started = time.perf_counter()
+    for message_id, turn in enumerate(trace, start=1):
+        user_id = args.user_offset + int(turn["user_id"])
+        handle_message(make_message(message_id, user_id, turn["text"]))
+        if args.concurrent:
+            continue
+
+        message_handlers.admission.drain(args.turn_timeout)
+        reply = bot.replies[user_id][-1] if bot.replies[user_id] else None
+        if reply in (None, Messages.BUSY):
+            continue
+        saved_messages[user_id] += 1
+        if reply == Messages.ERROR_GENERAL:
+            continue
+        expected[user_id].append((turn["text"], reply))
+
+        history = list(memory.get_history(user_id))
+        expected_history = [
+            {"role": role, "content": content}
+            for text, answer in expected[user_id]
+            for role, content in (("user", text), ("assistant", answer))
+        ]
+        if history != expected_history:
+            memory_errors.append(
+                f"user {user_id}, ход {message_id}: ожидалось {len(expected_history)} сообщений, "
+                f"получено {len(history)}"
+            )
+    message_handlers.admission.drain(args.turn_timeout * max(len(trace), 1))
+    message_handlers.thesis_scheduler.flush(args.turn_timeout * max(len(trace), 1))
+    elapsed = time.perf_counter() - started
+
+    if profiler:
+        profiler.stop()
+    snapshot = tracemalloc.take_snapshot() if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+    logging.getLogger().removeHandler(stage_collector)
+
+    # Проверка БД: количество сохраненных сообщений пользователя
+    db_errors = []
+    if db_ready and not args.concurrent:
+        for user_id, count in saved_messages.items():
+            stored = db_manager.get_user_messages_count(user_id)
+            if stored != count:
+                db_errors.append(f"user {user_id}: в БД {stored} сообщений пользователя, ожидалось {count}")
+
+    # Отчет
+    lines = []
+    total_replies = sum(len(r) for r in bot.replies.values())
+    lines.append("=== Воспроизведение ===")
+    lines.append(f"Ходов: {len(trace)}, пользователей: {len({t['user_id'] for t in trace})}, "
+                 f"ответов: {total_replies}, время: {elapsed:.2f} с, {len(trace) / elapsed:.1f} ходов/с")
+    lines.append(f"Вызовы модели: {dict(completions.calls)}, задержка заглушки: {args.model_latency * 1000:.0f} мс")
+    lines.append(f"Контроль допуска: {message_handlers.admission.get_stats()}")
+    lines.append(f"Планировщик тезисов: {message_handlers.thesis_scheduler.get_stats()}")
+    if message_handlers.response_cache is not None:
+        lines.append(f"Кэш ответов: {message_handlers.response_cache.get_stats()}")
+
+    lines.append("")
+    lines.append("=== Этапы (мс): count / mean / p50 / p95 / max ===")
+    for stage, values in stage_collector.stages.items():
+        ms = [v * 1000 for v in values]
+        lines.append(f"{stage:20s} {len(ms):6d} {sum(ms) / len(ms):9.2f} {_percentile(ms, 0.5):9.2f} "
+                     f"{_percentile(ms, 0.95):9.2f} {max(ms):9.2f}")
+
+    lines.append("")
+    lines.append("=== Вызовы DBManager: count / total мс / на ход ===")
+    for name in DB_METHODS:
+        if db_counter.calls[name]:
+            lines.append(f"{name:28s} {db_counter.calls[name]:6d} {db_counter.time[name] * 1000:10.1f} "
+                         f"{db_counter.calls[name] / len(trace):6.2f}")
+
+    lines.append("")
+    lines.append("=== Проверки ===")
+    if args.concurrent:
+        lines.append("Короткая память: пропущено (режим --concurrent)")
+    else:
+        lines.append(f"Короткая память (ограничение истории): {'OK' if not memory_errors else 'ОШИБКИ'}")
+        lines.extend(f"  {error}" for error in memory_errors[:20])
+    if not db_ready or args.concurrent:
+        lines.append("БД: пропущено")
+    else:
+        lines.append(f"БД (сообщения пользователей): {'OK' if not db_errors else 'ОШИБКИ'}")
+        lines.extend(f"  {error}" for error in db_errors[:20])
+
+    if profiler:
+        lines.append("")
+        lines.append(f"=== cProfile (топ {args.top}) ===")
+        lines.append(profiler.report(args.top))
+
+    if snapshot is not None:
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        lines.append("=== tracemalloc: по модулям проекта ===")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for stat in snapshot.statistics("filename"):
+            filename = stat.traceback[0].filename
+            if filename.startswith(root):
+                lines.append(f"{os.path.relpath(filename, root):32s} {stat.size / 1024:10.1f} KiB {stat.count:8d} блоков")
+        lines.append("")
+        lines.append(f"=== tracemalloc: топ {args.top} строк ===")
+        for stat in snapshot.statistics("lineno")[:args.top]:
+            lines.append(str(stat))
+
+    if not args.keep:
+        # Все ID воспроизведения, включая ходы без ответа и режим --concurrent
+        replayed_users = {args.user_offset + int(turn["user_id"]) for turn in trace}
+        db_manager.purge_users(
+            sorted(replayed_users),
+            cached_prompts=sorted({normalize_text(turn["text"]) for turn in trace}),
+            cached_since=replay_started_at
+        )
+
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение диалогов и профилирование бота")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--trace", help="JSONL-файл трассы")
+    source.add_argument("--from-db", action="store_true", help="Выгрузить трассу из таблицы messages")
+    source.add_argument("--synthesize", action="store_true", help="Сгенерировать синтетическую трассу")
+    parser.add_argument("--limit", type=int, default=1000, help="Сколько сообщений выгрузить из БД")
+    parser.add_argument("--db-user", type=int, help="Выгрузить из БД только этого пользователя")
+    parser.add_argument("--users", type=int, default=20, help="Пользователей в синтетической трассе")
+    parser.add_argument("--turns", type=int, default=15, help="Сообщений на пользователя в синтетической трассе")
+    parser.add_argument("--seed", type=int, default=1, help="Seed генератора синтетической трассы")
+    parser.add_argument("--export", help="Сохранить трассу в JSONL и выйти")
+    parser.add_argument("--model-latency", type=float, default=0.0, help="Задержка заглушки модели, сек")
+    parser.add_argument("--concurrent", action="store_true",
+                        help="Не ждать ответа на каждое сообщение (нагрузочный режим, без проверок)")
+    parser.add_argument("--user-offset", type=int, default=DEFAULT_USER_OFFSET, help="Смещение ID пользователей")
+    parser.add_argument("--db-host", help="Хост PostgreSQL (вместо DB_HOST из настроек)")
+    parser.add_argument("--allow-remote-db", action="store_true",
+                        help="Разрешить воспроизведение (запись в БД) на нелокальном хосте")
+    parser.add_argument("--db-timeout", type=float, default=15.0, help="Ожидание готовности БД, сек")
+    parser.add_argument("--turn-timeout", type=float, default=30.0, help="Ожидание обработки хода, сек")
+    parser.add_argument("--profile", action="store_true", help="Профилировать cProfile")
+    parser.add_argument("--tracemalloc", action="store_true", help="Отслеживать выделения памяти")
+    parser.add_argument("--top", type=int, default=25, help="Строк в разделах профилирования")
+    parser.add_argument("--keep", action="store_true", help="Не удалять данные воспроизведения из БД")
+    parser.add_argument("--report", default="replay_report.txt", help="Файл отчета")
+    args = parser.parse_args()
+
+    if args.db_host:
+        db_manager.conn_params["host"] = args.db_host
+
+    # В консоль только предупреждения; INFO-записи нужны сборщику времени этапов
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.WARNING)
+    console_handler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+    logging.getLogger().addHandler(console_handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    elif args.from_db:
+        trace = trace_from_db(args.limit, args.db_user)
+    else:
+        trace = synthesize_trace(args.users, args.turns, args.seed)
+
+    if args.export:
+        save_trace(trace, args.export)
+        print(f"Трасса сохранена: {args.export} ({len(trace)} ходов)")
+        return 0
+    if not trace:
+        print("Трасса пуста")
+        return 1
+
+    db_host = db_manager.conn_params["host"]
+    if db_host not in LOCAL_DB_HOSTS and not db_host.startswith("/") and not args.allow_remote_db:
+        print(f"Воспроизведение пишет в БД, а хост {db_host} не локальный. "
+              f"Укажите --db-host локальной БД или добавьте --allow-remote-db")
+        return 2
+
+    report = replay(trace, args)
+    with open(args.report, "w", encoding="utf-8") as f:
+        f.write(report + "\n")
+    print(report.split("=== cProfile")[0].split("=== tracemalloc")[0])
+    print(f"Полный отчет: {args.report}")
+    db_manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,275 @@
+"""
+Модуль контроля допуска запросов к AI (ограничение нагрузки и сброс при перегрузке)
+"""
+import time
+import logging
+import threading
+from collections import deque
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    """Задача в очереди допуска"""
+
+    __slots__ = ("user_id", "run", "on_expired", "checkpoint", "enqueued_at")
+
+    def __init__(
+        self,
+        user_id: int,
+        run: Callable[[], None],
+        on_expired: Optional[Callable[[], None]],
+        checkpoint: Optional[Callable[[], bool]]
+    ):
+        self.user_id = user_id
+        self.run = run
+        self.on_expired = on_expired
+        self.checkpoint = checkpoint
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionController:
+    """
+    Ограничивает число одновременных запросов к модели и длину очереди
+
+    Задачи выполняются собственным пулом потоков, поэтому потоки telebot освобождаются сразу,
+    и команды (/start, /help, /clear) обрабатываются без ожидания ответа модели.
+    Очередь справедливая: у каждого пользователя своя очередь с лимитом, пользователи
+    обслуживаются по кругу, и у одного пользователя одновременно выполняется не более
+    одной задачи (это также сохраняет порядок его сообщений).
+    """
+
+    # Выводить метрики очереди каждые N завершенных задач
+    STATS_LOG_EVERY = 100
+
+    def __init__(self, max_inflight: int = 4, max_queue: int = 100, max_per_user: int = 3, max_wait: float = 60.0):
+        """
+        Инициализация контроллера
+
+        Args:
+            max_inflight: Максимум одновременно выполняемых задач
+            max_queue: Максимум задач в очереди (всего)
+            max_per_user: Максимум задач в очереди от одного пользователя
+            max_wait: Максимальное ожидание в очереди, сек; более старые задачи не выполняются
+        """
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.max_wait = max_wait
+
+        self._cond = threading.Condition()
+        self._queues: Dict[int, deque] = {}
+        # Пользователи с задачами в очереди и без выполняющейся задачи, в порядке обслуживания
+        self._ready_users: deque = deque()
+        self._active_users = set()
+        self._running = set()
+        self._accepting = True
+        self._queued = 0
+        self._inflight = 0
+        self._workers = []
+        self._stats = {
+            "accepted": 0,
+            "rejected_queue_full": 0,
+            "rejected_user_limit": 0,
+            "expired": 0,
+            "completed": 0,
+            "failed": 0,
+            "total_wait": 0.0,
+            "max_wait": 0.0,
+        }
+
+    def _ensure_started(self):
+        """Запускает рабочие потоки при первой задаче (вызывается под блокировкой)"""
+        if self._workers:
+            return
+        for i in range(self.max_inflight):
+            worker = threading.Thread(target=self._worker_loop, name=f"admission-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(
+            "Контроль допуска запущен: %d одновременных запросов, очередь до %d (до %d на пользователя)",
+            self.max_inflight, self.max_queue, self.max_per_user
+        )
+
+    @property
+    def accepting(self) -> bool:
+        """Принимает ли контроллер новые задачи (False после начала остановки)"""
+        return self._accepting
+
+    def submit(
+        self,
+        user_id: int,
+        run: Callable[[], None],
+        on_expired: Callable[[], None] = None,
+        checkpoint: Callable[[], bool] = None
+    ) -> bool:
+        """
+        Ставит задачу в очередь, если есть место
+
+        Args:
+            user_id: ID пользователя
+            run: Функция обработки
+            on_expired: Функция, вызываемая вместо run, если задача прождала дольше max_wait
+            checkpoint: Функция сохранения задачи, если она не успела завершиться до остановки;
+                возвращает False, если задача уже завершается и сохранять ее не нужно
+
+        Returns:
+            True, если задача принята; False, если ее нужно отклонить (очередь заполнена или идет остановка)
+        """
+        with self._cond:
+            user_queue = self._queues.get(user_id)
+            if not self._accepting:
+                return False
+            if self._queued >= self.max_queue:
+                self._stats["rejected_queue_full"] += 1
+                reason = "очередь заполнена"
+            elif user_queue is not None and len(user_queue) >= self.max_per_user:
+                self._stats["rejected_user_limit"] += 1
+                reason = "превышен лимит пользователя"
+            else:
+                self._ensure_started()
+                if user_queue is None:
+                    user_queue = self._queues[user_id] = deque()
+                    if user_id not in self._active_users:
+                        self._ready_users.append(user_id)
+                user_queue.append(_Job(user_id, run, on_expired, checkpoint))
+                self._queued += 1
+                self._stats["accepted"] += 1
+                self._cond.notify()
+                return True
+            queued, inflight = self._queued, self._inflight
+
+        logger.warning(
+            "Запрос пользователя %s отклонен: %s (в очереди %d, выполняется %d)",
+            user_id, reason, queued, inflight
+        )
+        return False
+
+    def _next_job(self) -> _Job:
+        """Берет задачу следующего по кругу пользователя (блокируется, пока задач нет)"""
+        with self._cond:
+            while not self._ready_users:
+                self._cond.wait()
+            user_id = self._ready_users.popleft()
+            user_queue = self._queues[user_id]
+            job = user_queue.popleft()
+            if not user_queue:
+                del self._queues[user_id]
+            self._active_users.add(user_id)
+            self._running.add(job)
+            self._queued -= 1
+            self._inflight += 1
+
+            waited = time.monotonic() - job.enqueued_at
+            self._stats["total_wait"] += waited
+            self._stats["max_wait"] = max(self._stats["max_wait"], waited)
+            return job
+
+    def _finish_job(self, job: _Job, outcome: str):
+        """Освобождает слот и возвращает пользователя в круг, если у него остались задачи"""
+        with self._cond:
+            self._inflight -= 1
+            self._active_users.discard(job.user_id)
+            self._running.discard(job)
+            if job.user_id in self._queues:
+                self._ready_users.append(job.user_id)
+            # Будим и рабочие потоки, и ожидающий drain()
+            self._cond.notify_all()
+            self._stats[outcome] += 1
+            finished = self._stats["completed"] + self._stats["failed"] + self._stats["expired"]
+
+        if finished % self.STATS_LOG_EVERY == 0:
+            stats = self.get_stats()
+            logger.info(
+                "Очередь запросов: в очереди %d, выполняется %d, принято %d, отклонено %d, "
+                "устарело %d, среднее ожидание %.2fс, максимальное %.2fс",
+                stats["queued"], stats["inflight"], stats["accepted"],
+                stats["rejected_queue_full"] + stats["rejected_user_limit"], stats["expired"],
+                stats["avg_wait"], stats["max_wait"]
+            )
+
+    def _worker_loop(self):
+        """Цикл рабочего потока"""
+        while True:
+            job = self._next_job()
+            outcome = "completed"
+            try:
+                if time.monotonic() - job.enqueued_at > self.max_wait:
+                    # Поздний ответ хуже быстрого отказа: не тратим вызов модели
+                    outcome = "expired"
+                    logger.warning("Запрос пользователя %s устарел в очереди и не будет выполнен", job.user_id)
+                    if job.on_expired:
+                        job.on_expired()
+                else:
+                    job.run()
+            except Exception as e:
+                outcome = "failed"
+                logger.error("Ошибка при выполнении задачи пользователя %s: %s", job.user_id, e)
+            finally:
+                self._finish_job(job, outcome)
+
+    def stop_accepting(self):
+        """Прекращает прием новых задач; уже принятые продолжают выполняться"""
+        with self._cond:
+            self._accepting = False
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Ожидает завершения всех принятых задач
+
+        Args:
+            timeout: Максимальное время ожидания в секундах
+
+        Returns:
+            True, если очередь пуста и выполняющихся задач нет
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queued or self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def checkpoint_remaining(self) -> int:
+        """
+        Снимает с очереди невыполненные задачи и сохраняет их и выполняющиеся задачи через checkpoint
+
+        Returns:
+            Количество сохраненных задач
+        """
+        with self._cond:
+            jobs = [job for user_queue in self._queues.values() for job in user_queue]
+            jobs.extend(self._running)
+            self._queues.clear()
+            self._ready_users.clear()
+            self._queued = 0
+
+        saved = 0
+        for job in jobs:
+            if job.checkpoint is None:
+                continue
+            try:
+                if job.checkpoint():
+                    saved += 1
+            except Exception as e:
+                logger.error("Не удалось сохранить задачу пользователя %s: %s", job.user_id, e)
+        return saved
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        Получает метрики очереди
+
+        Returns:
+            Словарь с текущей длиной очереди, числом выполняемых задач и счетчиками
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queued"] = self._queued
+            stats["inflight"] = self._inflight
+            stats["waiting_users"] = len(self._queues)
+        started = stats["completed"] + stats["failed"] + stats["expired"] + stats["inflight"]
+        stats["avg_wait"] = stats["total_wait"] / started if started else 0.0
+        return stats
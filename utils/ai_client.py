@@ -1,6 +1,7 @@
 """
 Модуль для работы с OpenAI API через ProxyAPI
 """
+import json
 import time
 import traceback
 import logging
@@ -13,30 +14,45 @@ logger = logging.getLogger(__name__)
 class AIClient:
     """Класс для работы с OpenAI API"""
     
-    def __init__(self):
-        """Инициализация клиента OpenAI"""
+    # Максимальная длина тезисов одного пользователя в пакетном ответе; более длинные считаются некорректными
+    BATCH_THESES_MAX_CHARS = 2000
+    
+    def __init__(self, cache=None, usage_recorder=None):
+        """
+        Инициализация клиента OpenAI
+        
+        Args:
+            cache: Кэш ответов (ResponseCache) для запросов без персонального контекста или None
+            usage_recorder: Функция записи расхода токенов
+                (user_id, kind, model, prompt_tokens, completion_tokens, cached_tokens) или None
+        """
         self.client = OpenAI(
             api_key=Settings.OPENAI_API_KEY,
             base_url=Settings.OPENAI_BASE_URL,
         )
         self.model = Settings.AI_MODEL
+        self.cache = cache
+        self.usage_recorder = usage_recorder
+        self._cache_lookups = 0
     
-    def get_response(self, user_message: str, history: list = None, system_context: str = None) -> str:
+    def build_messages(self, user_message: str, history: list = None, system_context: str = None) -> list:
         """
-        Получает ответ от OpenAI через ProxyAPI
+        Формирует список сообщений для API в порядке от стабильного к изменчивому
+        
+        Порядок: статичные инструкции (одинаковы для всех запросов), тезисы пользователя
+        (меняются редко и только дописываются в конец), короткая история, новое сообщение.
+        Так общий префикс запросов остается побайтно неизменным между ходами и может
+        быть закэширован на стороне провайдера.
         
         Args:
             user_message: Сообщение пользователя
-            history: История предыдущих сообщений в формате [{"role": "user", "content": "..."}, ...]
-            system_context: Долгосрочный контекст (тезисы) для добавления в системный промпт
+            history: История предыдущих сообщений
+            system_context: Долгосрочный контекст (тезисы)
             
         Returns:
-            Ответ от AI модели
+            Список сообщений в формате OpenAI API
         """
-        start_time = time.time()
-        
-        # Формируем список сообщений для API
-        messages = []
+        messages = [{"role": "system", "content": Settings.AI_SYSTEM_PROMPT}]
         
         # Добавляем системный контекст (тезисы), если есть
         if system_context:
@@ -54,12 +70,41 @@ class AIClient:
             "role": "user",
             "content": user_message
         })
+        return messages
+    
+    def get_response(self, user_message: str, history: list = None, system_context: str = None, user_id: int = None) -> str:
+        """
+        Получает ответ от OpenAI через ProxyAPI
+        
+        Args:
+            user_message: Сообщение пользователя
+            history: История предыдущих сообщений в формате [{"role": "user", "content": "..."}, ...]
+            system_context: Долгосрочный контекст (тезисы) для добавления в системный промпт
+            user_id: ID пользователя для учета расхода токенов
+            
+        Returns:
+            Ответ от AI модели
+        """
+        start_time = time.time()
+        
+        # Формируем список сообщений для API
+        messages = self.build_messages(user_message, history=history, system_context=system_context)
+        
+        # Кэш применяется только к запросам без истории и тезисов: ответ не зависит от пользователя
+        use_cache = self.cache is not None and not history and not system_context
+        if use_cache:
+            cached_response = self.cache.get(self.model, messages)
+            self._log_cache_stats()
+            if cached_response:
+                logger.info("Ответ получен из кэша за %.3fс", time.time() - start_time)
+                return cached_response
+        elif self.cache is not None:
+            self.cache.record_bypass()
         
         try:
             logger.debug(
-                f"Отправка запроса к OpenAI API. "
-                f"Длина сообщения: {len(user_message)} символов. "
-                f"История: {len(history) if history else 0} сообщений"
+                "Отправка запроса к OpenAI API. Длина сообщения: %d символов. История: %d сообщений",
+                len(user_message), len(history) if history else 0
             )
             
             chat_completion = self.client.chat.completions.create(
@@ -68,18 +113,22 @@ class AIClient:
             )
             
             elapsed_time = time.time() - start_time
+            self._record_usage(user_id, 'reply', chat_completion)
             
             # Извлекаем ответ из completion
             response = chat_completion.choices[0].message.content
             
-            # Логируем информацию о запросе
-            response_preview = response[:100] + "..." if len(response) > 100 else response
-            logger.info(
-                f"Получен ответ от OpenAI API за {elapsed_time:.2f}с. "
-                f"Длина ответа: {len(response)} символов. "
-                f"Превью: {response_preview}"
-            )
-            logger.debug(f"Полный ответ от API: {response}")
+            # Логируем информацию о запросе (превью строится, только если запись будет выведена)
+            if response and logger.isEnabledFor(logging.INFO):
+                response_preview = response[:100] + "..." if len(response) > 100 else response
+                logger.info(
+                    "Получен ответ от OpenAI API за %.2fс. Длина ответа: %d символов. Превью: %s",
+                    elapsed_time, len(response), response_preview
+                )
+            logger.debug("Полный ответ от API: %s", response)
+            
+            if use_cache and response:
+                self.cache.put(self.model, messages, response, elapsed_time)
             
             return response if response else None
             
@@ -87,17 +136,86 @@ class AIClient:
             elapsed_time = time.time() - start_time
             error_traceback = traceback.format_exc()
             logger.error(
-                f"Ошибка при запросе к OpenAI API (время выполнения: {elapsed_time:.2f}с): {e}\n"
-                f"Traceback:\n{error_traceback}"
+                "Ошибка при запросе к OpenAI API (время выполнения: %.2fс): %s\nTraceback:\n%s",
+                elapsed_time, e, error_traceback
             )
             raise
     
-    def generate_theses(self, messages: list) -> str:
+    def _record_usage(self, user_id: int, kind: str, chat_completion):
+        """
+        Передает расход токенов из ответа API в usage_recorder
+        
+        Args:
+            user_id: ID пользователя
+            kind: Тип запроса ('reply' или 'theses')
+            chat_completion: Ответ API
+        """
+        self._record_usage_split(kind, chat_completion, {user_id: 1})
+    
+    def _record_usage_split(self, kind: str, chat_completion, weights: dict):
+        """
+        Передает расход токенов в usage_recorder, распределяя его между пользователями пропорционально весам
+        
+        Args:
+            kind: Тип запроса ('reply', 'theses' или 'theses_batch')
+            chat_completion: Ответ API
+            weights: Словарь {user_id: вес} (например, объем сообщений пользователя в пакетном запросе)
+        """
+        usage = getattr(chat_completion, 'usage', None)
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        tokens = (
+            usage.prompt_tokens or 0,
+            usage.completion_tokens or 0,
+            (getattr(details, 'cached_tokens', None) or 0) if details else 0,
+        )
+        
+        logger.debug(
+            "Токены: prompt=%d (из кэша провайдера %d), completion=%d",
+            tokens[0], tokens[2], tokens[1]
+        )
+        if self.usage_recorder is None:
+            return
+        
+        # Целочисленное распределение: остаток от округления достается последнему пользователю,
+        # поэтому суммы по пользователям совпадают с расходом запроса
+        if not sum(weights.values()):
+            weights = dict.fromkeys(weights, 1)
+        user_ids = list(weights)
+        total_weight = sum(weights.values())
+        remaining = list(tokens)
+        for index, user_id in enumerate(user_ids):
+            if index == len(user_ids) - 1:
+                share = remaining
+            else:
+                share = [total * weights[user_id] // total_weight for total in tokens]
+                remaining = [left - part for left, part in zip(remaining, share)]
+            try:
+                self.usage_recorder(user_id, kind, self.model, share[0], share[1], share[2])
+            except Exception as e:
+                logger.error("Ошибка при записи расхода токенов: %s", e)
+    
+    def _log_cache_stats(self):
+        """Периодически выводит статистику кэша ответов"""
+        self._cache_lookups += 1
+        if self._cache_lookups % Settings.RESPONSE_CACHE_STATS_EVERY:
+            return
+        stats = self.cache.get_stats()
+        logger.info(
+            "Кэш ответов: доля попаданий %.1f%% (точных %d, похожих %d, из БД %d, промахов %d, "
+            "в обход %d), сэкономлено %.1fс, записей %d",
+            stats["hit_rate"] * 100, stats["exact_hits"], stats["near_hits"], stats["store_hits"],
+            stats["misses"], stats["bypassed"], stats["saved_latency"], stats["size"]
+        )
+    
+    def generate_theses(self, messages: list, user_id: int = None) -> str:
         """
         Генерирует тезисы из последних сообщений пользователя для долгосрочной памяти
         
         Args:
             messages: Список последних сообщений пользователя
+            user_id: ID пользователя для учета расхода токенов
             
         Returns:
             Тезисы в виде текста
@@ -123,7 +241,7 @@ class AIClient:
 
 Ответ дай ТОЛЬКО в виде тезисов, без дополнительного текста."""
 
-            logger.debug(f"Генерация тезисов для {len(messages)} сообщений")
+            logger.debug("Генерация тезисов для %d сообщений", len(messages))
             
             chat_completion = self.client.chat.completions.create(
                 model=self.model,
@@ -136,13 +254,14 @@ class AIClient:
             )
             
             elapsed_time = time.time() - start_time
+            self._record_usage(user_id, 'theses', chat_completion)
             theses = chat_completion.choices[0].message.content
             
             logger.info(
-                f"Тезисы сгенерированы за {elapsed_time:.2f}с. "
-                f"Длина: {len(theses)} символов"
+                "Тезисы сгенерированы за %.2fс. Длина: %d символов",
+                elapsed_time, len(theses) if theses else 0
             )
-            logger.debug(f"Сгенерированные тезисы: {theses}")
+            logger.debug("Сгенерированные тезисы: %s", theses)
             
             return theses if theses else ""
             
@@ -150,8 +269,114 @@ class AIClient:
             elapsed_time = time.time() - start_time
             error_traceback = traceback.format_exc()
             logger.error(
-                f"Ошибка при генерации тезисов (время выполнения: {elapsed_time:.2f}с): {e}\n"
-                f"Traceback:\n{error_traceback}"
+                "Ошибка при генерации тезисов (время выполнения: %.2fс): %s\nTraceback:\n%s",
+                elapsed_time, e, error_traceback
             )
             return ""
+    
+    def generate_theses_batch(self, jobs: dict) -> dict:
+        """
+        Генерирует тезисы для нескольких пользователей одним запросом
+        
+        Args:
+            jobs: Словарь {user_id: список сообщений пользователя}
+            
+        Returns:
+            Словарь {user_id: тезисы} только для пользователей с корректным результатом;
+            остальных нужно обработать отдельными запросами generate_theses
+        """
+        if not jobs:
+            return {}
+        
+        start_time = time.time()
+        # В запросе пользователи пронумерованы: ID пользователей модели не передаются
+        user_ids = list(jobs)
+        payload = {str(index): jobs[user_id] for index, user_id in enumerate(user_ids, 1)}
+        
+        try:
+            prompt = f"""Ниже в формате JSON сообщения нескольких разных пользователей: ключ — номер пользователя, значение — список его сообщений.
+Для КАЖДОГО пользователя отдельно проанализируй только его сообщения и создай краткие тезисы (2-3 предложения), 
+отражающие главные темы, интересы и важную информацию:
 
+{json.dumps(payload, ensure_ascii=False)}
+
+Тезисы должны быть:
+- Краткими и информативными
+- Без лишних деталей
+- Сфокусированными на ключевых моментах
+- В формате списка через точку с запятой
+
+Ответ дай ТОЛЬКО в виде JSON-объекта, где ключ — номер пользователя, а значение — строка с его тезисами,
+например: {{"1": "тезисы первого пользователя", "2": "тезисы второго пользователя"}}"""
+
+            logger.debug("Пакетная генерация тезисов для %d пользователей", len(user_ids))
+            
+            chat_completion = self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ],
+                response_format={"type": "json_object"}
+            )
+            
+            elapsed_time = time.time() - start_time
+            # Расход пакета распределяется между пользователями пропорционально объему их сообщений
+            self._record_usage_split(
+                'theses_batch', chat_completion,
+                {user_id: sum(len(msg) for msg in jobs[user_id]) for user_id in user_ids}
+            )
+            theses = self._parse_theses_batch(chat_completion.choices[0].message.content, user_ids)
+            
+            logger.info(
+                "Пакетные тезисы сгенерированы за %.2fс: корректны для %d из %d пользователей",
+                elapsed_time, len(theses), len(user_ids)
+            )
+            return theses
+            
+        except Exception as e:
+            elapsed_time = time.time() - start_time
+            error_traceback = traceback.format_exc()
+            logger.error(
+                "Ошибка при пакетной генерации тезисов (время выполнения: %.2fс): %s\nTraceback:\n%s",
+                elapsed_time, e, error_traceback
+            )
+            return {}
+    
+    def _parse_theses_batch(self, content: str, user_ids: list) -> dict:
+        """
+        Разбирает и проверяет ответ пакетной генерации тезисов
+        
+        Args:
+            content: Текст ответа модели
+            user_ids: ID пользователей в порядке нумерации в запросе
+            
+        Returns:
+            Словарь {user_id: тезисы} для пользователей с непустыми тезисами допустимой длины
+        """
+        try:
+            data = json.loads(content or "")
+        except ValueError:
+            logger.warning("Ответ пакетной генерации тезисов не является JSON")
+            return {}
+        if not isinstance(data, dict):
+            logger.warning("Ответ пакетной генерации тезисов не является JSON-объектом")
+            return {}
+        
+        theses = {}
+        for index, user_id in enumerate(user_ids, 1):
+            value = data.get(str(index))
+            if not isinstance(value, str):
+                continue
+            value = value.strip()
+            if value and len(value) <= self.BATCH_THESES_MAX_CHARS:
+                theses[user_id] = value
+        
+        if len(theses) < len(user_ids):
+            logger.warning(
+                "Пакетный ответ без корректных тезисов для %d из %d пользователей",
+                len(user_ids) - len(theses), len(user_ids)
+            )
+        return theses
@@ -0,0 +1,8 @@
+"""
+Модуль для работы с базой данных (единый экземпляр)
+"""
+from utils.db_manager import DBManager
+
+# Единый экземпляр менеджера БД для всего приложения.
+# Подключение выполняется лениво в фоне: см. DBManager.start()
+db_manager = DBManager()
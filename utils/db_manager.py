@@ -1,10 +1,16 @@
 """
 Модуль для работы с базой данных PostgreSQL
 """
-import psycopg2
-from psycopg2.extras import DictCursor
+import time
 import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extras import DictCursor, execute_values
 from config.settings import Settings
+from utils.migrations import apply_migrations
 
 logger = logging.getLogger(__name__)
 
@@ -13,82 +19,166 @@ class DBManager:
     """Класс для управления подключением и запросами к PostgreSQL"""
 
     def __init__(self):
+        """
+        Инициализация менеджера БД
+
+        Подключение не выполняется: пул соединений и миграции создаются в фоновом
+        потоке при вызове start() или при первом обращении к БД.
+        """
         self.conn_params = {
             "host": Settings.DB_HOST,
             "port": Settings.DB_PORT,
             "database": Settings.DB_NAME,
             "user": Settings.DB_USER,
-            "password": Settings.DB_PASSWORD
+            "password": Settings.DB_PASSWORD,
+            "connect_timeout": Settings.DB_CONNECT_TIMEOUT
         }
-        logger.info(f"Инициализация DBManager с хостом: {Settings.DB_HOST}:{Settings.DB_PORT}, база: {Settings.DB_NAME}")
-        
-        # Добавляем повторные попытки подключения при старте
-        import time
-        max_retries = 10
-        connected = False
-        for i in range(max_retries):
+        self.pool = None
+        # ThreadedConnectionPool сразу бросает PoolError, когда все соединения заняты;
+        # семафор заставляет поток дождаться свободного соединения
+        self._pool_slots = threading.BoundedSemaphore(Settings.DB_POOL_MAX)
+        self.schema_version = 0
+        self._ready = threading.Event()
+        self._start_lock = threading.Lock()
+        self._init_thread = None
+        # Записи, поступившие до готовности БД; применяются по порядку после подключения
+        self._pending_lock = threading.Lock()
+        self._pending_writes = deque()
+
+    def start(self):
+        """Запускает фоновое подключение к БД и применение миграций (без ожидания)"""
+        with self._start_lock:
+            if self._ready.is_set() or (self._init_thread and self._init_thread.is_alive()):
+                return
+            logger.info(
+                "Инициализация DBManager с хостом: %s:%s, база: %s",
+                Settings.DB_HOST, Settings.DB_PORT, Settings.DB_NAME
+            )
+            self._init_thread = threading.Thread(target=self._init_worker, name="db-init", daemon=True)
+            self._init_thread.start()
+
+    def is_ready(self) -> bool:
+        """Возвращает True, если БД подключена и схема актуальна"""
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        """
+        Ожидает готовности БД
+
+        Args:
+            timeout: Максимальное время ожидания в секундах
+
+        Returns:
+            True, если БД готова
+        """
+        self.start()
+        return self._ready.wait(timeout)
+
+    def _init_worker(self):
+        """Подключается к БД с повторными попытками, пока она не станет доступна"""
+        attempt = 0
+        while not self._ready.is_set():
+            attempt += 1
             try:
                 self._init_db()
-                connected = True
-                break
             except Exception as e:
-                if i == max_retries - 1:
-                    logger.error(f"Не удалось подключиться к БД после {max_retries} попыток: {e}")
-                    # Не выбрасываем исключение здесь, чтобы бот мог попытаться запуститься, 
-                    # но при первом запросе к БД он все равно упадет
-                else:
-                    logger.warning(f"Попытка подключения к БД {i+1}/{max_retries} не удалась. Ожидание 3 сек...")
-                    time.sleep(3)
-
-    def _get_connection(self):
-        """Создает новое соединение с БД"""
-        return psycopg2.connect(**self.conn_params)
+                delay = min(Settings.DB_INIT_RETRY_DELAY * attempt, 30)
+                logger.warning(
+                    "Попытка подключения к БД %d не удалась: %s. Ожидание %d сек...",
+                    attempt, e, delay
+                )
+                time.sleep(delay)
 
     def _init_db(self):
-        """Создает необходимые таблицы, если они не существуют"""
+        """Создает пул соединений, применяет миграции и выполняет отложенные записи"""
+        pool = ThreadedConnectionPool(Settings.DB_POOL_MIN, Settings.DB_POOL_MAX, **self.conn_params)
         try:
-            with self._get_connection() as conn:
-                with conn.cursor() as cur:
-                    # Таблица сообщений
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS messages (
-                            id SERIAL PRIMARY KEY,
-                            user_id BIGINT NOT NULL,
-                            role VARCHAR(20) NOT NULL,
-                            content TEXT NOT NULL,
-                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                        );
-                    """)
-                    # Таблица тезисов (Long-term context)
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS theses (
-                            user_id BIGINT PRIMARY KEY,
-                            content TEXT NOT NULL,
-                            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                        );
-                    """)
+            conn = pool.getconn()
+            try:
+                self.schema_version = apply_migrations(conn)
+            finally:
+                pool.putconn(conn)
+        except Exception:
+            pool.closeall()
+            raise
+        self.pool = pool
+
+        with self._pending_lock:
+            if self._pending_writes:
+                logger.info("Выполнение %d отложенных записей в БД", len(self._pending_writes))
+            while self._pending_writes:
+                operation, args = self._pending_writes.popleft()
+                operation(*args)
+            self._ready.set()
+        logger.info("База данных успешно инициализирована (версия схемы: %d)", self.schema_version)
+
+    @contextmanager
+    def _connection(self):
+        """Выдает соединение из пула (ожидая освобождения, если все заняты) и возвращает его после использования"""
+        if not self._pool_slots.acquire(timeout=Settings.DB_POOL_WAIT_TIMEOUT):
+            logger.warning("Нет свободных соединений с БД в течение %d с", Settings.DB_POOL_WAIT_TIMEOUT)
+            raise PoolError("connection pool exhausted")
+        try:
+            conn = self.pool.getconn()
+            try:
+                yield conn
                 conn.commit()
-            logger.info("База данных успешно инициализирована")
-        except Exception as e:
-            logger.error(f"Ошибка при инициализации БД: {e}")
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._pool_slots.release()
+
+    def _write(self, operation, *args):
+        """
+        Выполняет запись сразу или откладывает ее до готовности БД
+
+        Args:
+            operation: Функция, выполняющая запись
+            *args: Аргументы функции
+        """
+        with self._pending_lock:
+            if not self._ready.is_set():
+                if len(self._pending_writes) >= Settings.DB_PENDING_WRITES_LIMIT:
+                    logger.error("Очередь отложенных записей в БД переполнена, запись отброшена")
+                else:
+                    self._pending_writes.append((operation, args))
+                self.start()
+                return
+        operation(*args)
+
+    def _can_read(self) -> bool:
+        """Проверяет готовность БД для чтения; если БД не готова, запускает инициализацию"""
+        if self._ready.is_set():
+            return True
+        self.start()
+        logger.debug("БД еще не готова, чтение пропущено")
+        return False
 
     def save_message(self, user_id: int, role: str, content: str):
         """Сохраняет сообщение в БД"""
+        self._write(self._save_message, user_id, role, content)
+
+    def _save_message(self, user_id: int, role: str, content: str):
         try:
-            with self._get_connection() as conn:
+            with self._connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute(
                         "INSERT INTO messages (user_id, role, content) VALUES (%s, %s, %s)",
                         (user_id, role, content)
                     )
-                conn.commit()
         except Exception as e:
             logger.error(f"Ошибка при сохранении сообщения: {e}")
 
     def get_user_messages_count(self, user_id: int) -> int:
         """Возвращает количество сообщений пользователя"""
+        if not self._can_read():
+            return 0
         try:
-            with self._get_connection() as conn:
+            with self._connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute(
                         "SELECT COUNT(*) FROM messages WHERE user_id = %s AND role = 'user'",
@@ -99,43 +189,92 @@ class DBManager:
             logger.error(f"Ошибка при получении счетчика сообщений: {e}")
             return 0
 
-    def get_recent_user_messages(self, user_id: int, limit: int = 3) -> list:
-        """Возвращает последние N сообщений пользователя"""
+    def export_messages(self, limit: int = 1000, user_id: int = None) -> list:
+        """
+        Возвращает сообщения для выгрузки трассы диалогов
+
+        Args:
+            limit: Максимум сообщений (самые свежие)
+            user_id: Выгрузить только сообщения этого пользователя
+
+        Returns:
+            Список кортежей (user_id, role, content) в хронологическом порядке
+        """
+        if not self._can_read():
+            return []
         try:
-            with self._get_connection() as conn:
+            with self._connection() as conn:
                 with conn.cursor() as cur:
-                    cur.execute(
-                        "SELECT content FROM messages WHERE user_id = %s AND role = 'user' ORDER BY id DESC LIMIT %s",
-                        (user_id, limit)
-                    )
-                    rows = cur.fetchall()
-                    return [row[0] for row in reversed(rows)]
+                    cur.execute("""
+                        SELECT user_id, role, content FROM (
+                            SELECT id, user_id, role, content FROM messages
+                            WHERE %(user_id)s::BIGINT IS NULL OR user_id = %(user_id)s
+                            ORDER BY id DESC LIMIT %(limit)s
+                        ) recent ORDER BY id
+                    """, {"user_id": user_id, "limit": limit})
+                    return cur.fetchall()
         except Exception as e:
-            logger.error(f"Ошибка при получении последних сообщений: {e}")
+            logger.error(f"Ошибка при выгрузке сообщений: {e}")
             return []
 
-    def save_thesis(self, user_id: int, new_thesis: str):
-        """Обновляет или создает тезисы для пользователя (накопительно)"""
+    def get_unsummarized_messages(self, user_id: int) -> list:
+        """
+        Возвращает сообщения пользователя после контрольной точки тезисов
+
+        Returns:
+            Список кортежей (id, content) в хронологическом порядке
+        """
+        if not self._can_read():
+            return []
         try:
-            current_theses = self.get_theses(user_id)
-            combined_content = f"{current_theses}\n{new_thesis}".strip() if current_theses else new_thesis
-            
-            with self._get_connection() as conn:
+            with self._connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
-                        INSERT INTO theses (user_id, content, updated_at) 
-                        VALUES (%s, %s, CURRENT_TIMESTAMP)
-                        ON CONFLICT (user_id) DO UPDATE 
-                        SET content = EXCLUDED.content, updated_at = CURRENT_TIMESTAMP;
-                    """, (user_id, combined_content))
-                conn.commit()
+                        SELECT m.id, m.content FROM messages m
+                        LEFT JOIN theses t ON t.user_id = m.user_id
+                        WHERE m.user_id = %s AND m.role = 'user' AND m.id > COALESCE(t.last_message_id, 0)
+                        ORDER BY m.id
+                    """, (user_id,))
+                    return cur.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка при получении необобщенных сообщений: {e}")
+            return []
+
+    def save_theses_bulk(self, items: list):
+        """
+        Обновляет или создает тезисы нескольких пользователей одним запросом (накопительно)
+
+        Args:
+            items: Список кортежей (user_id, тезисы, last_message_id); user_id не должны повторяться
+        """
+        if items:
+            self._write(self._save_theses_bulk, list(items))
+
+    def _save_theses_bulk(self, items: list):
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    execute_values(cur, """
+                        INSERT INTO theses (user_id, content, last_message_id, updated_at)
+                        VALUES %s
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET content = CASE
+                                WHEN EXCLUDED.content = '' THEN theses.content
+                                WHEN theses.content = '' THEN EXCLUDED.content
+                                ELSE theses.content || E'\\n' || EXCLUDED.content
+                            END,
+                            last_message_id = GREATEST(theses.last_message_id, EXCLUDED.last_message_id),
+                            updated_at = CURRENT_TIMESTAMP;
+                    """, items, template="(%s, %s, %s, CURRENT_TIMESTAMP)")
         except Exception as e:
             logger.error(f"Ошибка при сохранении тезисов: {e}")
 
     def get_theses(self, user_id: int) -> str:
         """Возвращает накопленные тезисы пользователя"""
+        if not self._can_read():
+            return ""
         try:
-            with self._get_connection() as conn:
+            with self._connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute("SELECT content FROM theses WHERE user_id = %s", (user_id,))
                     row = cur.fetchone()
@@ -146,12 +285,246 @@ class DBManager:
 
     def clear_all_history(self, user_id: int):
         """Полная очистка истории в БД"""
+        self._write(self._clear_all_history, user_id)
+
+    def _clear_all_history(self, user_id: int):
         try:
-            with self._get_connection() as conn:
+            with self._connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute("DELETE FROM messages WHERE user_id = %s", (user_id,))
                     cur.execute("DELETE FROM theses WHERE user_id = %s", (user_id,))
-                conn.commit()
             logger.info(f"Вся история в БД для пользователя {user_id} удалена")
         except Exception as e:
             logger.error(f"Ошибка при очистке истории в БД: {e}")
+
+    def purge_users(self, user_ids: list, cached_prompts: list = None, cached_since: float = None):
+        """
+        Удаляет все данные пользователей: сообщения, тезисы, расход токенов и незавершенные ходы
+
+        Используется для очистки тестовых данных (например, после tools/replay.py).
+
+        Args:
+            user_ids: ID пользователей
+            cached_prompts: Нормализованные запросы, записи кэша ответов для которых тоже удаляются
+            cached_since: Удалять записи кэша ответов не старше этого момента (unix time)
+        """
+        if user_ids:
+            self._write(self._purge_users, list(user_ids), list(cached_prompts or []), cached_since or 0)
+
+    def _purge_users(self, user_ids: list, cached_prompts: list, cached_since: float):
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    for table in ("messages", "theses", "usage", "pending_turns"):
+                        cur.execute(f"DELETE FROM {table} WHERE user_id = ANY(%s)", (user_ids,))
+                    if cached_prompts:
+                        cur.execute(
+                            "DELETE FROM response_cache WHERE prompt = ANY(%s) AND created_at >= to_timestamp(%s)",
+                            (cached_prompts, cached_since)
+                        )
+            logger.info("Данные %d пользователей удалены из БД", len(user_ids))
+        except Exception as e:
+            logger.error(f"Ошибка при удалении данных пользователей: {e}")
+
+    def get_cached_response(self, cache_key: str, ttl: float):
+        """
+        Возвращает сохраненный ответ из кэша, если он не старше ttl
+
+        Returns:
+            Кортеж (ответ, время получения исходного ответа, возраст записи в секундах) или None
+        """
+        if not self._can_read():
+            return None
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        UPDATE response_cache SET hits = hits + 1
+                        WHERE cache_key = %s AND created_at > CURRENT_TIMESTAMP - make_interval(secs => %s)
+                        RETURNING response, latency, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - created_at)
+                    """, (cache_key, ttl))
+                    row = cur.fetchone()
+                    return (row[0], row[1], float(row[2])) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка при чтении кэша ответов: {e}")
+            return None
+
+    def save_cached_response(self, cache_key: str, model: str, prompt: str, response: str, latency: float):
+        """Сохраняет ответ в постоянный кэш (без отложенной записи: кэш не критичен)"""
+        if not self._can_read():
+            return
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO response_cache (cache_key, model, prompt, response, latency)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON CONFLICT (cache_key) DO UPDATE
+                        SET response = EXCLUDED.response, latency = EXCLUDED.latency,
+                            created_at = CURRENT_TIMESTAMP;
+                    """, (cache_key, model, prompt, response, latency))
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении кэша ответов: {e}")
+
+    def prune_cached_responses(self, ttl: float, max_rows: int):
+        """
+        Удаляет из постоянного кэша устаревшие записи и самые старые записи сверх лимита
+
+        Args:
+            ttl: Время жизни записи в секундах
+            max_rows: Максимальное количество записей
+        """
+        if not self._can_read():
+            return
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "DELETE FROM response_cache WHERE created_at <= CURRENT_TIMESTAMP - make_interval(secs => %s)",
+                        (ttl,)
+                    )
+                    expired = cur.rowcount
+                    cur.execute("""
+                        DELETE FROM response_cache WHERE cache_key IN (
+                            SELECT cache_key FROM response_cache ORDER BY created_at DESC OFFSET %s
+                        )
+                    """, (max_rows,))
+                    evicted = cur.rowcount
+            if expired or evicted:
+                logger.info("Постоянный кэш ответов: удалено устаревших %d, сверх лимита %d", expired, evicted)
+        except Exception as e:
+            logger.error(f"Ошибка при очистке кэша ответов: {e}")
+
+    def save_usage(self, user_id: int, kind: str, model: str, prompt_tokens: int,
+                   completion_tokens: int, cached_tokens: int):
+        """Сохраняет расход токенов по одному запросу к API"""
+        self._write(self._save_usage, user_id, kind, model, prompt_tokens, completion_tokens, cached_tokens)
+
+    def _save_usage(self, user_id: int, kind: str, model: str, prompt_tokens: int,
+                    completion_tokens: int, cached_tokens: int):
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO usage (user_id, kind, model, prompt_tokens, completion_tokens, cached_tokens)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                    """, (user_id, kind, model, prompt_tokens, completion_tokens, cached_tokens))
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении расхода токенов: {e}")
+
+    def _get_usage(self, group_by: str, days: int, limit: int, condition: str = "TRUE") -> list:
+        """
+        Агрегирует расход токенов за последние days дней
+
+        Args:
+            group_by: SQL-выражение группировки
+            days: Глубина выборки в днях
+            limit: Максимум строк (сортировка по стоимости)
+            condition: Дополнительное SQL-условие отбора строк
+
+        Returns:
+            Список словарей с суммами токенов, долей кэшированных токенов и стоимостью
+        """
+        if not self._can_read():
+            return []
+        try:
+            with self._connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    cur.execute(f"""
+                        SELECT {group_by} AS key,
+                               COUNT(*) AS requests,
+                               SUM(prompt_tokens) AS prompt_tokens,
+                               SUM(completion_tokens) AS completion_tokens,
+                               SUM(cached_tokens) AS cached_tokens,
+                               SUM((prompt_tokens - cached_tokens) * %(input_price)s
+                                   + cached_tokens * %(cached_price)s
+                                   + completion_tokens * %(output_price)s) / 1000000.0 AS cost
+                        FROM usage
+                        WHERE created_at >= CURRENT_DATE - make_interval(days => %(days)s) AND {condition}
+                        GROUP BY 1
+                        ORDER BY cost DESC
+                        LIMIT %(limit)s
+                    """, {
+                        "input_price": Settings.AI_PRICE_INPUT_PER_1M,
+                        "cached_price": Settings.AI_PRICE_CACHED_INPUT_PER_1M,
+                        "output_price": Settings.AI_PRICE_OUTPUT_PER_1M,
+                        "days": days,
+                        "limit": limit,
+                    })
+                    rows = [dict(row) for row in cur.fetchall()]
+            for row in rows:
+                row["cache_hit_ratio"] = row["cached_tokens"] / row["prompt_tokens"] if row["prompt_tokens"] else 0.0
+            return rows
+        except Exception as e:
+            logger.error(f"Ошибка при получении статистики расхода токенов: {e}")
+            return []
+
+    def get_usage_by_day(self, days: int = 7) -> list:
+        """Возвращает расход токенов по дням"""
+        rows = self._get_usage("created_at::date", days, days + 1)
+        return sorted(rows, key=lambda row: row["key"])
+
+    def get_usage_by_user(self, days: int = 7, limit: int = 10) -> list:
+        """Возвращает пользователей с наибольшей стоимостью запросов"""
+        return self._get_usage("user_id", days, limit, condition="user_id IS NOT NULL")
+
+    def save_pending_turn(self, user_id: int, payload: str, user_saved: bool):
+        """Сохраняет ход диалога, не завершенный до остановки бота"""
+        self._write(self._save_pending_turn, user_id, payload, user_saved)
+
+    def _save_pending_turn(self, user_id: int, payload: str, user_saved: bool):
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "INSERT INTO pending_turns (user_id, payload, user_saved) VALUES (%s, %s, %s)",
+                        (user_id, payload, user_saved)
+                    )
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении незавершенного хода: {e}")
+
+    def take_pending_turns(self) -> list:
+        """
+        Извлекает и удаляет сохраненные незавершенные ходы
+
+        Returns:
+            Список кортежей (user_id, payload, user_saved) в порядке поступления
+        """
+        if not self._can_read():
+            return []
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM pending_turns RETURNING id, user_id, payload, user_saved")
+                    rows = sorted(cur.fetchall())
+                    return [(row[1], row[2], row[3]) for row in rows]
+        except Exception as e:
+            logger.error(f"Ошибка при получении незавершенных ходов: {e}")
+            return []
+
+    def flush(self, timeout: float) -> bool:
+        """
+        Дожидается записи отложенных изменений, если БД еще не была готова
+
+        Args:
+            timeout: Максимальное время ожидания в секундах
+
+        Returns:
+            True, если отложенных записей не осталось
+        """
+        with self._pending_lock:
+            pending = len(self._pending_writes)
+        if not pending:
+            return True
+        logger.info("Ожидание подключения к БД для записи %d отложенных изменений", pending)
+        if self.wait_ready(timeout):
+            return True
+        with self._pending_lock:
+            logger.error("БД недоступна, потеряно %d отложенных записей", len(self._pending_writes))
+        return False
+
+    def close(self):
+        """Закрывает все соединения пула"""
+        if self.pool is not None:
+            self.pool.closeall()
+            logger.info("Соединения с БД закрыты")
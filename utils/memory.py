@@ -2,141 +2,148 @@
 Модуль для хранения короткой памяти диалогов пользователей
 """
 import logging
-from typing import List, Dict, Optional
-from collections import defaultdict
+import threading
+from typing import Deque, Dict, Optional, Tuple
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
+# Ход диалога: (текст пользователя, текст ответа); отсутствующая часть хода — None
+Turn = Tuple[Optional[str], Optional[str]]
+
+
+def _turn_size(turn: Turn) -> int:
+    """Количество сообщений в ходе"""
+    return (turn[0] is not None) + (turn[1] is not None)
+
 
 class ConversationMemory:
     """Класс для хранения истории диалогов пользователей"""
-    
+
     def __init__(self, max_messages: int = 10):
         """
         Инициализация памяти диалогов
-        
+
         Args:
             max_messages: Максимальное количество сообщений пользователя в истории (по умолчанию 10)
         """
         self.max_messages = max_messages
-        # Хранилище истории: {user_id: [{"role": "user", "content": "..."}, {"role": "assistant", "content": "..."}, ...]}
-        self.conversations: Dict[int, List[Dict[str, str]]] = defaultdict(list)
+        # Хранилище истории: {user_id: deque(maxlen=max_messages) ходов}. Переполненный deque сам
+        # вытесняет самый старый ход, поэтому добавление и ограничение истории выполняются за O(1).
+        # Ходы хранятся компактными кортежами строк, словари для API создаются только при чтении
+        self.conversations: Dict[int, Deque[Turn]] = {}
+        # Неизменяемые снимки истории для чтения; сбрасываются при изменении истории пользователя
+        self._snapshots: Dict[int, Tuple[Dict[str, str], ...]] = {}
+        self._total_messages = 0
+        # Историю изменяют рабочие потоки контроля допуска и потоки telebot (/clear)
+        self._lock = threading.Lock()
         logger.info(f"Инициализирована память диалогов с максимумом {max_messages} сообщений пользователя")
-    
+
+    def _turns(self, user_id: int) -> Deque[Turn]:
+        """Возвращает кольцевой буфер ходов пользователя, создавая его при необходимости"""
+        turns = self.conversations.get(user_id)
+        if turns is None:
+            turns = self.conversations[user_id] = deque(maxlen=self.max_messages)
+        return turns
+
+    def _append_turn(self, user_id: int, turns: Deque[Turn], turn: Turn) -> None:
+        """Добавляет ход, учитывая в счетчике сообщения вытесняемого хода"""
+        if len(turns) == turns.maxlen:
+            self._total_messages -= _turn_size(turns[0])
+            logger.debug("История пользователя %s ограничена до %d сообщений", user_id, self.max_messages)
+        turns.append(turn)
+        self._total_messages += _turn_size(turn)
+        self._snapshots.pop(user_id, None)
+
     def add_user_message(self, user_id: int, message: str) -> None:
         """
         Добавляет сообщение пользователя в историю
-        
+
         Args:
             user_id: ID пользователя
             message: Текст сообщения
         """
-        if user_id not in self.conversations:
-            self.conversations[user_id] = []
-        
-        self.conversations[user_id].append({
-            "role": "user",
-            "content": message
-        })
-        
-        logger.debug(f"Добавлено сообщение пользователя {user_id} в историю. Всего сообщений: {len(self.conversations[user_id])}")
-    
+        with self._lock:
+            turns = self._turns(user_id)
+            self._append_turn(user_id, turns, (message, None))
+
+        logger.debug("Добавлено сообщение пользователя %s в историю. Всего ходов: %d", user_id, len(turns))
+
     def add_assistant_message(self, user_id: int, message: str) -> None:
         """
         Добавляет ответ ассистента в историю
-        
+
         Args:
             user_id: ID пользователя
             message: Текст ответа
         """
-        if user_id not in self.conversations:
-            self.conversations[user_id] = []
-        
-        self.conversations[user_id].append({
-            "role": "assistant",
-            "content": message
-        })
-        
-        # Ограничиваем историю до max_messages сообщений пользователя
-        self._limit_history(user_id)
-        
-        logger.debug(f"Добавлен ответ ассистента для пользователя {user_id} в историю")
-    
-    def get_history(self, user_id: int) -> List[Dict[str, str]]:
+        with self._lock:
+            turns = self._turns(user_id)
+
+            if turns and turns[-1][1] is None:
+                # Дополняем последний ход ответом на месте
+                turns[-1] = (turns[-1][0], message)
+                self._total_messages += 1
+                self._snapshots.pop(user_id, None)
+            else:
+                # Ответ без предшествующего сообщения пользователя хранится отдельным ходом
+                self._append_turn(user_id, turns, (None, message))
+
+        logger.debug("Добавлен ответ ассистента для пользователя %s в историю", user_id)
+
+    def get_history(self, user_id: int) -> Tuple[Dict[str, str], ...]:
         """
         Получает историю диалога пользователя
-        
+
+        Снимок строится один раз после изменения истории и переиспользуется при чтениях
+        до следующего изменения. Сообщения в снимке не должны изменяться вызывающим кодом.
+
         Args:
             user_id: ID пользователя
-            
+
         Returns:
-            Список сообщений в формате для OpenAI API
+            Кортеж сообщений в формате для OpenAI API
         """
-        history = self.conversations.get(user_id, [])
-        logger.debug(f"Получена история для пользователя {user_id}: {len(history)} сообщений")
-        return history.copy()
-    
+        snapshot = self._snapshots.get(user_id)
+        if snapshot is None:
+            with self._lock:
+                turns = self.conversations.get(user_id)
+                if not turns:
+                    return ()
+                messages = []
+                for user_text, assistant_text in turns:
+                    if user_text is not None:
+                        messages.append({"role": "user", "content": user_text})
+                    if assistant_text is not None:
+                        messages.append({"role": "assistant", "content": assistant_text})
+                snapshot = self._snapshots[user_id] = tuple(messages)
+        logger.debug("Получена история для пользователя %s: %d сообщений", user_id, len(snapshot))
+        return snapshot
+
     def clear_history(self, user_id: int) -> None:
         """
         Очищает историю диалога пользователя
-        
+
         Args:
             user_id: ID пользователя
         """
-        if user_id in self.conversations:
-            del self.conversations[user_id]
+        with self._lock:
+            turns: Optional[Deque[Turn]] = self.conversations.pop(user_id, None)
+            self._snapshots.pop(user_id, None)
+            if turns is not None:
+                self._total_messages -= sum(_turn_size(turn) for turn in turns)
+        if turns is not None:
             logger.info(f"История диалога пользователя {user_id} очищена")
-    
-    def _limit_history(self, user_id: int) -> None:
-        """
-        Ограничивает историю до max_messages сообщений пользователя
-        
-        Args:
-            user_id: ID пользователя
-        """
-        if user_id not in self.conversations:
-            return
-        
-        history = self.conversations[user_id]
-        
-        # Подсчитываем количество сообщений пользователя
-        user_message_count = sum(1 for msg in history if msg["role"] == "user")
-        
-        # Если сообщений пользователя больше max_messages, удаляем старые пары
-        if user_message_count > self.max_messages:
-            # Удаляем пары (user, assistant) пока не останется max_messages сообщений пользователя
-            while user_message_count > self.max_messages:
-                # Удаляем первую пару сообщений
-                if len(history) >= 2 and history[0]["role"] == "user" and history[1]["role"] == "assistant":
-                    history.pop(0)  # Удаляем сообщение пользователя
-                    history.pop(0)  # Удаляем ответ ассистента
-                    user_message_count -= 1
-                elif len(history) >= 1 and history[0]["role"] == "user":
-                    # Если есть только сообщение пользователя без ответа
-                    history.pop(0)
-                    user_message_count -= 1
-                else:
-                    # Если структура неожиданная, очищаем историю
-                    logger.warning(f"Неожиданная структура истории для пользователя {user_id}, очищаем")
-                    history.clear()
-                    break
-            
-            logger.info(
-                f"История пользователя {user_id} ограничена до {self.max_messages} сообщений. "
-                f"Удалено старых сообщений"
-            )
-    
+
     def get_stats(self) -> Dict[str, int]:
         """
         Получает статистику использования памяти
-        
+
         Returns:
             Словарь со статистикой
         """
-        total_users = len(self.conversations)
-        total_messages = sum(len(history) for history in self.conversations.values())
-        return {
-            "total_users": total_users,
-            "total_messages": total_messages
-        }
-
+        with self._lock:
+            return {
+                "total_users": len(self.conversations),
+                "total_messages": self._total_messages
+            }
@@ -27,7 +27,13 @@ class Messages:
     ERROR_AI_RESPONSE = "Извините, не удалось получить ответ."
     ERROR_AI_REQUEST = "Извините, произошла ошибка при обработке вашего запроса. Попробуйте позже."
     ERROR_GENERAL = "Извините, произошла ошибка. Попробуйте позже."
+    BUSY = "⏳ Сейчас слишком много запросов. Пожалуйста, повторите сообщение через минуту."
     
     # Сообщение об очистке истории
     HISTORY_CLEARED = "✅ История нашего разговора очищена. Начнем с чистого листа!"
-
+    
+    # Статистика расхода токенов (команда /usage для администраторов)
+    USAGE_NO_DATA = "Нет данных о расходе токенов за последние 7 дней."
+    USAGE_DAYS_HEADER = "📊 Расход по дням (7 дней):"
+    USAGE_USERS_HEADER = "👤 Топ пользователей по стоимости:"
+    USAGE_ROW = "{key}: {requests} запр., {prompt_tokens}+{completion_tokens} ток., кэш {cache_hit_ratio:.0%}, ${cost:.4f}"
@@ -0,0 +1,177 @@
+"""
+Модуль версионированных миграций схемы PostgreSQL
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки, чтобы миграции не применялись параллельно несколькими процессами
+MIGRATIONS_LOCK_KEY = 7_317_001
+
+# Список миграций: (версия, описание, SQL-выражения). Новые миграции добавляются только в конец.
+MIGRATIONS = [
+    (
+        1,
+        "Таблицы сообщений и тезисов",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                role VARCHAR(20) NOT NULL,
+                content TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS theses (
+                user_id BIGINT PRIMARY KEY,
+                content TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+        ],
+    ),
+    (
+        2,
+        "Индекс сообщений по пользователю",
+        [
+            "CREATE INDEX IF NOT EXISTS idx_messages_user_role_id ON messages (user_id, role, id);",
+        ],
+    ),
+    (
+        3,
+        "Таблица кэша ответов",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS response_cache (
+                cache_key CHAR(64) PRIMARY KEY,
+                model VARCHAR(100) NOT NULL,
+                prompt TEXT NOT NULL,
+                response TEXT NOT NULL,
+                latency REAL NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+        ],
+    ),
+    (
+        4,
+        "Учет расхода токенов",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS usage (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT,
+                kind VARCHAR(20) NOT NULL,
+                model VARCHAR(100) NOT NULL,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                cached_tokens INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_usage_created_at ON usage (created_at);",
+            "CREATE INDEX IF NOT EXISTS idx_usage_user_created_at ON usage (user_id, created_at);",
+        ],
+    ),
+    (
+        5,
+        "Незавершенные при остановке ходы диалога",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS pending_turns (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                payload TEXT NOT NULL,
+                user_saved BOOLEAN NOT NULL DEFAULT FALSE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+        ],
+    ),
+    (
+        6,
+        "Контрольная точка тезисов: последнее обобщенное сообщение",
+        [
+            "ALTER TABLE theses ADD COLUMN IF NOT EXISTS last_message_id BIGINT NOT NULL DEFAULT 0;",
+            # Для уже накопленных тезисов считаем обобщенными все имеющиеся сообщения
+            """
+            UPDATE theses t SET last_message_id = COALESCE(
+                (SELECT MAX(m.id) FROM messages m WHERE m.user_id = t.user_id AND m.role = 'user'), 0
+            );
+            """,
+        ],
+    ),
+    (
+        7,
+        "Индекс кэша ответов по времени создания (очистка по TTL и лимиту)",
+        [
+            "CREATE INDEX IF NOT EXISTS idx_response_cache_created_at ON response_cache (created_at);",
+        ],
+    ),
+]
+
+
+def get_schema_version(cur) -> int:
+    """
+    Возвращает текущую версию схемы
+
+    Args:
+        cur: Курсор открытого соединения
+
+    Returns:
+        Номер последней примененной миграции (0, если миграций не было)
+    """
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+
+def apply_migrations(conn) -> int:
+    """
+    Применяет недостающие миграции и записывает версию схемы
+
+    Каждая миграция выполняется в отдельной транзакции вместе с записью в schema_version.
+
+    Args:
+        conn: Соединение с БД
+
+    Returns:
+        Версия схемы после применения миграций
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+    conn.commit()
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+        try:
+            current_version = get_schema_version(cur)
+            for version, description, statements in MIGRATIONS:
+                if version <= current_version:
+                    continue
+                logger.info("Применение миграции %d: %s", version, description)
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                    (version, description)
+                )
+                conn.commit()
+                current_version = version
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if not conn.closed:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+                conn.commit()
+
+    return current_version
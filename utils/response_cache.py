@@ -0,0 +1,373 @@
+"""
+Модуль кэша ответов AI для запросов без персонального контекста
+"""
+import re
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Простое число Мерсенна для универсального хэширования MinHash
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_WORD_RE = re.compile(r"\w+")
+
+# Слова короче этого должны совпадать точно: в коротких словах одна правка меняет смысл ("не"/"на")
+_TYPO_MIN_WORD_LEN = 4
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к нижнему регистру и схлопывает пробелы"""
+    return _WHITESPACE_RE.sub(" ", text.lower()).strip()
+
+
+def _edit_distance(first: str, second: str) -> int:
+    """Расстояние Дамерау-Левенштейна (перестановка соседних букв — одна правка)"""
+    previous2, previous = None, list(range(len(second) + 1))
+    for i, a in enumerate(first, 1):
+        current = [i] + [0] * len(second)
+        for j, b in enumerate(second, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a != b))
+            if i > 1 and j > 1 and a == second[j - 2] and first[i - 2] == b:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def is_typo_variant(first: tuple, second: tuple) -> bool:
+    """
+    Проверяет, что запросы отличаются только опечатками
+
+    Слова должны идти в том же порядке; отличающиеся слова допускаются только длинные
+    и без цифр, с одной правкой (двумя — для слов от 8 букв), и не больше одного слова из десяти.
+    Так замена имени, сущности или добавление отрицания не считается опечаткой.
+
+    Args:
+        first: Слова первого запроса
+        second: Слова второго запроса
+
+    Returns:
+        True, если запросы можно считать одинаковыми
+    """
+    if len(first) != len(second):
+        return False
+    differences = 0
+    for a, b in zip(first, second):
+        if a == b:
+            continue
+        differences += 1
+        if differences > max(1, len(first) // 10):
+            return False
+        if min(len(a), len(b)) < _TYPO_MIN_WORD_LEN or any(ch.isdigit() for ch in a + b):
+            return False
+        if _edit_distance(a, b) > (1 if max(len(a), len(b)) < 8 else 2):
+            return False
+    return True
+
+
+class _Entry:
+    """Запись кэша"""
+
+    __slots__ = ("response", "latency", "created_at", "scope", "signature", "words")
+
+    def __init__(self, response: str, latency: float, created_at: float, scope: str, signature: tuple, words: tuple):
+        self.response = response
+        self.latency = latency
+        self.created_at = created_at
+        self.scope = scope
+        self.signature = signature
+        self.words = words
+
+
+class ResponseCache:
+    """
+    Ограниченный LRU/TTL-кэш ответов с поиском почти совпадающих запросов
+
+    Точное совпадение ищется по ключу из нормализованной модели и полного содержимого промпта.
+    Почти совпадающие запросы находятся по MinHash-сигнатуре символьных шинглов последнего
+    сообщения с LSH-индексом; сравниваются только запросы с одинаковой моделью и одинаковым
+    остальным промптом. Поиск похожих запросов включается отдельно (near_match) и принимает
+    только различия на уровне опечаток (is_typo_variant).
+    """
+
+    # Очищать постоянное хранилище при каждой N-й записи (и при первой)
+    STORE_PRUNE_EVERY = 100
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl: float = 86400,
+        near_threshold: float = 0.9,
+        near_match: bool = False,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle_size: int = 4,
+        store=None,
+        store_max_rows: int = 10000
+    ):
+        """
+        Инициализация кэша
+
+        Args:
+            max_size: Максимальное количество записей в памяти
+            ttl: Время жизни записи в секундах
+            near_threshold: Минимальная оценка сходства Жаккара для почти совпадающего запроса
+            near_match: Искать почти совпадающие запросы (отличающиеся только опечатками)
+            num_perm: Количество хэш-функций MinHash
+            bands: Количество полос LSH (num_perm должно делиться на bands)
+            shingle_size: Длина символьного шингла
+            store: Постоянное хранилище (DBManager) или None
+            store_max_rows: Максимальное количество записей в постоянном хранилище
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm должно делиться на bands")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.near_threshold = near_threshold
+        self.near_match = near_match
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.store = store
+        self.store_max_rows = store_max_rows
+        self._store_puts = 0
+
+        # Коэффициенты перестановок MinHash детерминированы, чтобы сигнатуры были стабильны между запусками
+        seed = hashlib.sha256(b"response-cache-minhash").digest()
+        self._perms = []
+        for i in range(num_perm):
+            digest = hashlib.blake2b(seed + i.to_bytes(4, "little"), digest_size=16).digest()
+            a = int.from_bytes(digest[:8], "little") % (_MERSENNE_PRIME - 1) + 1
+            b = int.from_bytes(digest[8:], "little") % _MERSENNE_PRIME
+            self._perms.append((a, b))
+
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._buckets: Dict[tuple, set] = defaultdict(set)
+        self._lock = threading.Lock()
+        self._stats = {
+            "exact_hits": 0,
+            "near_hits": 0,
+            "store_hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "evictions": 0,
+            "saved_latency": 0.0,
+        }
+
+        logger.info(
+            "Инициализирован кэш ответов: до %d записей, TTL %d с, поиск похожих запросов %s",
+            max_size, ttl, f"включен (порог {near_threshold:.2f})" if near_match else "выключен"
+        )
+
+    def make_key(self, model: str, messages: List[Dict[str, str]]) -> str:
+        """
+        Строит ключ кэша из нормализованной модели и полного содержимого промпта
+
+        Args:
+            model: Название модели
+            messages: Сообщения запроса к API
+
+        Returns:
+            Хэш ключа
+        """
+        parts = [model.strip().lower()]
+        for msg in messages:
+            parts.append(f"{msg['role']}\x1f{normalize_text(msg['content'])}")
+        return hashlib.sha256("\x1e".join(parts).encode("utf-8")).hexdigest()
+
+    def _scope(self, model: str, messages: List[Dict[str, str]]) -> str:
+        """Ключ области сравнения: модель и все сообщения, кроме последнего"""
+        return self.make_key(model, messages[:-1])
+
+    def _signature(self, text: str) -> tuple:
+        """Вычисляет MinHash-сигнатуру символьных шинглов текста"""
+        size = self.shingle_size
+        if len(text) <= size:
+            shingles = {text}
+        else:
+            shingles = {text[i:i + size] for i in range(len(text) - size + 1)}
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+            for s in shingles
+        ]
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self._perms
+        )
+
+    def _band_keys(self, scope: str, signature: tuple):
+        """Ключи LSH-корзин для сигнатуры (без сигнатуры — нет корзин)"""
+        if signature is None:
+            return []
+        rows = self.rows
+        return [(scope, i, signature[i * rows:(i + 1) * rows]) for i in range(self.bands)]
+
+    def _similarity(self, first: tuple, second: tuple) -> float:
+        """Оценка сходства Жаккара по двум сигнатурам"""
+        return sum(1 for x, y in zip(first, second) if x == y) / self.num_perm
+
+    def _remove(self, key: str):
+        """Удаляет запись и ее LSH-корзины (вызывается под блокировкой)"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for band_key in self._band_keys(entry.scope, entry.signature):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def _insert(self, key: str, entry: _Entry):
+        """Добавляет запись и вытесняет самые старые по LRU (вызывается под блокировкой)"""
+        self._remove(key)
+        self._entries[key] = entry
+        for band_key in self._band_keys(entry.scope, entry.signature):
+            self._buckets[band_key].add(key)
+        while len(self._entries) > self.max_size:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self._stats["evictions"] += 1
+
+    def _is_fresh(self, entry: _Entry, now: float) -> bool:
+        """Проверяет, не истек ли TTL записи"""
+        return now - entry.created_at <= self.ttl
+
+    def _hit(self, kind: str, entry: _Entry) -> str:
+        """Учитывает попадание в статистике (вызывается под блокировкой)"""
+        self._stats[kind] += 1
+        self._stats["saved_latency"] += entry.latency
+        return entry.response
+
+    def get(self, model: str, messages: List[Dict[str, str]]) -> Optional[str]:
+        """
+        Ищет ответ для запроса: точное совпадение, затем почти совпадающий запрос, затем хранилище
+
+        Args:
+            model: Название модели
+            messages: Сообщения запроса к API
+
+        Returns:
+            Ответ из кэша или None
+        """
+        key = self.make_key(model, messages)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_fresh(entry, now):
+                    self._entries.move_to_end(key)
+                    return self._hit("exact_hits", entry)
+                self._remove(key)
+
+        last_text = normalize_text(messages[-1]["content"])
+        scope = self._scope(model, messages)
+        signature, words = None, ()
+        if self.near_match:
+            # Сигнатура считается вне блокировки: это самая дорогая часть поиска
+            signature = self._signature(last_text)
+            words = tuple(_WORD_RE.findall(last_text))
+
+            with self._lock:
+                candidates = set()
+                for band_key in self._band_keys(scope, signature):
+                    candidates.update(self._buckets.get(band_key, ()))
+
+                best_key, best_score = None, 0.0
+                for candidate_key in candidates:
+                    candidate = self._entries.get(candidate_key)
+                    if candidate is None or not self._is_fresh(candidate, now):
+                        continue
+                    score = self._similarity(signature, candidate.signature)
+                    if score < self.near_threshold or score <= best_score:
+                        continue
+                    # Высокое сходство шинглов не исключает другой смысл ("Европа"/"Азия", другое имя,
+                    # отрицание, другие числа): допускаем только различия на уровне опечаток
+                    if not is_typo_variant(words, candidate.words):
+                        continue
+                    best_key, best_score = candidate_key, score
+
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    logger.debug("Кэш ответов: почти совпадающий запрос (сходство %.2f)", best_score)
+                    return self._hit("near_hits", self._entries[best_key])
+
+        if self.store is not None:
+            row = self.store.get_cached_response(key, self.ttl)
+            if row is not None:
+                # Запись сохраняет исходный возраст: загрузка из БД не продлевает TTL
+                response, latency, age = row
+                entry = _Entry(response, latency, now - age, scope, signature, words)
+                with self._lock:
+                    self._insert(key, entry)
+                    return self._hit("store_hits", entry)
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def put(self, model: str, messages: List[Dict[str, str]], response: str, latency: float):
+        """
+        Сохраняет ответ в кэш
+
+        Args:
+            model: Название модели
+            messages: Сообщения запроса к API
+            response: Ответ модели
+            latency: Время получения ответа от API в секундах
+        """
+        key = self.make_key(model, messages)
+        last_text = normalize_text(messages[-1]["content"])
+        entry = _Entry(
+            response,
+            latency,
+            time.time(),
+            self._scope(model, messages),
+            self._signature(last_text) if self.near_match else None,
+            tuple(_WORD_RE.findall(last_text)) if self.near_match else ()
+        )
+        with self._lock:
+            self._insert(key, entry)
+
+        if self.store is not None:
+            self.store.save_cached_response(key, model, last_text, response, latency)
+            # Периодически удаляем из хранилища устаревшие записи и записи сверх лимита
+            with self._lock:
+                prune = self._store_puts % self.STORE_PRUNE_EVERY == 0
+                self._store_puts += 1
+            if prune:
+                self.store.prune_cached_responses(self.ttl, self.store_max_rows)
+
+    def record_bypass(self):
+        """Учитывает запрос, для которого кэш не применялся из-за персонального контекста"""
+        with self._lock:
+            self._stats["bypassed"] += 1
+
+    def clear(self):
+        """Очищает кэш в памяти"""
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        Получает статистику кэша
+
+        Returns:
+            Словарь со счетчиками попаданий, долей попаданий и сэкономленным временем
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        hits = stats["exact_hits"] + stats["near_hits"] + stats["store_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,267 @@
+"""
+Модуль пакетной генерации тезисов для нескольких пользователей
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Задача генерации тезисов: (ID последнего обобщаемого сообщения, тексты сообщений,
+# остались ли необобщенные сообщения после этой задачи)
+ThesisJob = Tuple[int, List[str], bool]
+
+
+class ThesisScheduler:
+    """
+    Собирает задачи генерации тезисов разных пользователей и обрабатывает их пакетами
+
+    Задачи копятся в течение окна window (или до max_users пользователей), затем
+    сообщения всех пользователей пакета отправляются одним структурированным запросом
+    (крупные пакеты делятся на части по max_chars, части выполняются параллельно).
+    Пользователи, для которых пакетный ответ не удалось разобрать, обрабатываются
+    отдельными запросами с тем же ограничением параллельности. Все полученные тезисы
+    записываются в БД одной пакетной операцией.
+    """
+
+    def __init__(
+        self,
+        prepare: Callable[[int], Optional[ThesisJob]],
+        generate_batch: Callable[[Dict[int, List[str]]], Dict[int, str]],
+        generate_single: Callable[[List[str], int], str],
+        save_bulk: Callable[[List[Tuple[int, str, int]]], None],
+        on_saved: Callable[[int], None] = None,
+        window: float = 5.0,
+        max_users: int = 20,
+        max_chars: int = 24000,
+        concurrency: int = 2
+    ):
+        """
+        Инициализация планировщика
+
+        Args:
+            prepare: Функция подготовки задачи пользователя: (last_message_id, тексты, остались ли сообщения)
+                или None, если обобщать нечего; при оставшихся сообщениях пользователь ставится в очередь снова
+            generate_batch: Функция пакетной генерации {user_id: тексты} -> {user_id: тезисы}
+                (в результате только пользователи с корректными тезисами)
+            generate_single: Функция генерации тезисов одного пользователя (тексты, user_id) -> тезисы
+            save_bulk: Функция записи тезисов списком (user_id, тезисы, last_message_id)
+            on_saved: Функция, вызываемая для каждого пользователя после записи тезисов
+            window: Окно накопления задач, сек
+            max_users: Максимум пользователей в пакете
+            max_chars: Максимум символов сообщений в одном запросе к модели
+            concurrency: Максимум одновременных запросов к модели
+        """
+        self.prepare = prepare
+        self.generate_batch = generate_batch
+        self.generate_single = generate_single
+        self.save_bulk = save_bulk
+        self.on_saved = on_saved
+        self.window = window
+        self.max_users = max_users
+        self.max_chars = max_chars
+        self.concurrency = concurrency
+
+        self._cond = threading.Condition()
+        # Ожидающие пользователи в порядке поступления (dict как упорядоченное множество)
+        self._pending: Dict[int, None] = {}
+        self._inflight = set()
+        self._window_started = 0.0
+        self._flush_requested = False
+        self._worker = None
+        self._executor = None
+        self._stats = {
+            "batches": 0,
+            "users": 0,
+            "batch_requests": 0,
+            "single_requests": 0,
+            "fallback_users": 0,
+            "failed_users": 0,
+        }
+
+    def _ensure_started(self):
+        """Запускает фоновый поток и пул запросов при первой задаче (вызывается под блокировкой)"""
+        if self._worker is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="thesis-ai")
+        self._worker = threading.Thread(target=self._worker_loop, name="thesis-scheduler", daemon=True)
+        self._worker.start()
+        logger.info(
+            "Планировщик тезисов запущен: окно %.1fс, до %d пользователей в пакете, до %d запросов одновременно",
+            self.window, self.max_users, self.concurrency
+        )
+
+    def submit(self, user_id: int) -> None:
+        """
+        Ставит пользователя в очередь на генерацию тезисов
+
+        Повторная постановка до обработки не создает новую задачу: при обработке
+        берутся все сообщения пользователя после контрольной точки.
+
+        Args:
+            user_id: ID пользователя
+        """
+        with self._cond:
+            if user_id in self._pending or user_id in self._inflight:
+                return
+            self._ensure_started()
+            if not self._pending:
+                self._window_started = time.monotonic()
+            self._pending[user_id] = None
+            self._cond.notify_all()
+
+    def _next_batch(self) -> List[int]:
+        """Ждет окончания окна или заполнения пакета и забирает пользователей пакета"""
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            while len(self._pending) < self.max_users and not self._flush_requested:
+                remaining = self._window_started + self.window - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = list(self._pending)[:self.max_users]
+            for user_id in batch:
+                del self._pending[user_id]
+            self._inflight.update(batch)
+            return batch
+
+    def _worker_loop(self):
+        """Цикл фонового потока"""
+        while True:
+            batch = self._next_batch()
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.error("Ошибка при пакетной генерации тезисов: %s", e)
+            finally:
+                with self._cond:
+                    self._inflight.difference_update(batch)
+                    if not self._pending:
+                        self._flush_requested = False
+                    self._cond.notify_all()
+
+    def _split(self, jobs: Dict[int, ThesisJob]) -> List[Dict[int, List[str]]]:
+        """Делит пакет на запросы так, чтобы объем сообщений в каждом не превышал max_chars"""
+        groups, group, group_chars = [], {}, 0
+        for user_id, (_, texts, _) in jobs.items():
+            chars = sum(len(text) for text in texts)
+            if group and group_chars + chars > self.max_chars:
+                groups.append(group)
+                group, group_chars = {}, 0
+            group[user_id] = texts
+            group_chars += chars
+        if group:
+            groups.append(group)
+        return groups
+
+    def _generate_group(self, group: Dict[int, List[str]]) -> Dict[int, str]:
+        """Генерирует тезисы для части пакета; пакетный запрос имеет смысл только для нескольких пользователей"""
+        if len(group) == 1:
+            user_id, texts = next(iter(group.items()))
+            return {user_id: self.generate_single(texts, user_id)}
+        return self.generate_batch(group)
+
+    def _process(self, user_ids: List[int]):
+        """Обрабатывает пакет: подготовка, пакетные запросы, запасные отдельные запросы, пакетная запись"""
+        start_time = time.time()
+        jobs: Dict[int, ThesisJob] = {}
+        theses: Dict[int, str] = {}
+        for user_id in user_ids:
+            job = self.prepare(user_id)
+            if job is None:
+                continue
+            jobs[user_id] = job
+            if not job[1]:
+                # Только тривиальные сообщения: сдвигаем контрольную точку без запроса к модели
+                theses[user_id] = ""
+
+        pending = {user_id: job for user_id, job in jobs.items() if job[1]}
+        groups = self._split(pending)
+        results = list(self._executor.map(self._generate_group, groups))
+        batch_requests = sum(1 for group in groups if len(group) > 1)
+
+        # Пользователи пакетных запросов без корректного результата — отдельными запросами
+        fallback = []
+        for group, result in zip(groups, results):
+            for user_id in group:
+                if result.get(user_id):
+                    theses[user_id] = result[user_id]
+                elif len(group) > 1:
+                    fallback.append(user_id)
+        if fallback:
+            logger.warning("Пакетный ответ не разобран для %d пользователей, выполняем отдельные запросы", len(fallback))
+            single_results = self._executor.map(lambda uid: self.generate_single(pending[uid][1], uid), fallback)
+            for user_id, result in zip(fallback, single_results):
+                if result:
+                    theses[user_id] = result
+
+        # Пользователи без тезисов (ошибка генерации) остаются с прежней контрольной точкой и будут обобщены позже
+        items = [(user_id, theses[user_id], jobs[user_id][0]) for user_id in jobs if user_id in theses]
+        if items:
+            self.save_bulk(items)
+            if self.on_saved:
+                for user_id, _, _ in items:
+                    self.on_saved(user_id)
+
+        # Сообщения, не поместившиеся в задачу, обобщаются следующим пакетом
+        followups = [user_id for user_id, _, _ in items if jobs[user_id][2]]
+        if followups:
+            with self._cond:
+                if not self._pending:
+                    self._window_started = time.monotonic()
+                for user_id in followups:
+                    self._pending[user_id] = None
+
+        failed = len(jobs) - len(items)
+        with self._cond:
+            self._stats["batches"] += 1
+            self._stats["users"] += len(items)
+            self._stats["batch_requests"] += batch_requests
+            self._stats["single_requests"] += len(groups) - batch_requests + len(fallback)
+            self._stats["fallback_users"] += len(fallback)
+            self._stats["failed_users"] += failed
+
+        logger.info(
+            "Пакет тезисов обработан за %.2fс: пользователей %d, пакетных запросов %d, отдельных %d, ошибок %d",
+            time.time() - start_time, len(items), batch_requests,
+            len(groups) - batch_requests + len(fallback), failed
+        )
+
+    def flush(self, timeout: float) -> bool:
+        """
+        Обрабатывает накопленные задачи без ожидания окна и дожидается их завершения
+
+        Args:
+            timeout: Максимальное время ожидания в секундах
+
+        Returns:
+            True, если все задачи обработаны
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self._pending:
+                self._flush_requested = True
+                self._cond.notify_all()
+            while self._pending or self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Получает метрики планировщика
+
+        Returns:
+            Словарь со счетчиками пакетов, запросов и пользователей
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+            stats["inflight"] = len(self._inflight)
+        return stats
@@ -0,0 +1,198 @@
+"""
+Модуль политик запуска генерации тезисов
+"""
+import re
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w+")
+
+# Сообщения, не несущие информации для долгосрочной памяти
+TRIVIAL_MESSAGES = {
+    "ok", "ок", "окей", "ага", "да", "нет", "угу", "понял", "поняла", "ясно", "хорошо", "отлично", "супер",
+    "спасибо", "спс", "благодарю", "thanks", "thank you", "thx", "привет", "hi", "hello", "пока", "yes", "no",
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка количества токенов (~3 символа на токен для смешанного русского/английского текста)"""
+    return len(text) // 3 + 1
+
+
+class ThesisTriggerPolicy:
+    """Базовая политика: решает, когда обобщать накопленные сообщения пользователя в тезисы"""
+
+    def is_trivial(self, text: str) -> bool:
+        """Возвращает True для сообщений без информации для тезисов (исключаются из обобщения)"""
+        return " ".join(_WORD_RE.findall(text.lower())) in TRIVIAL_MESSAGES
+
+    def observe(self, user_id: int, text: str) -> bool:
+        """
+        Учитывает новое сообщение пользователя
+
+        Args:
+            user_id: ID пользователя
+            text: Текст сообщения
+
+        Returns:
+            True, если пора генерировать тезисы
+        """
+        raise NotImplementedError
+
+    def due_idle(self, now: float = None) -> List[int]:
+        """
+        Возвращает пользователей, чьи накопленные сообщения пора обобщить из-за паузы в диалоге
+
+        Возвращенные пользователи считаются запущенными: если генерация не удалась,
+        повторно они вернутся не раньше, чем через следующий период паузы.
+        """
+        return []
+
+    def mark_summarized(self, user_id: int) -> None:
+        """Сбрасывает накопленный объем после генерации тезисов"""
+
+    def forget(self, user_id: int) -> None:
+        """Удаляет состояние пользователя (например, после /clear)"""
+
+
+class EveryNMessagesPolicy(ThesisTriggerPolicy):
+    """Прежнее поведение: тезисы после каждых N сообщений пользователя"""
+
+    def __init__(self, every: int = 3):
+        self.every = every
+        self._counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, user_id: int, text: str) -> bool:
+        with self._lock:
+            count = self._counts[user_id] = self._counts.get(user_id, 0) + 1
+        return count % self.every == 0
+
+    def forget(self, user_id: int) -> None:
+        with self._lock:
+            self._counts.pop(user_id, None)
+
+
+class _VolumeState:
+    """Накопленный объем необобщенных сообщений пользователя"""
+
+    __slots__ = ("tokens", "last_activity", "last_idle_attempt")
+
+    def __init__(self, tokens: int, last_activity: float):
+        self.tokens = tokens
+        self.last_activity = last_activity
+        # Время последнего запуска по паузе: при неудачной генерации повтор не раньше чем через idle_seconds
+        self.last_idle_attempt = 0.0
+
+
+class TokenVolumePolicy(ThesisTriggerPolicy):
+    """
+    Тезисы по объему: накапливает оценку токенов необобщенных сообщений пользователя,
+    не учитывая тривиальные и короткие реплики, и срабатывает при достижении порога или после паузы в диалоге
+    """
+
+    def __init__(
+        self,
+        token_threshold: int = 600,
+        idle_seconds: float = 900,
+        min_idle_tokens: int = 40,
+        short_max_chars: int = 12,
+        loader: Optional[Callable[[int], List[str]]] = None
+    ):
+        """
+        Инициализация политики
+
+        Args:
+            token_threshold: Объем (в токенах), при котором тезисы генерируются сразу
+            idle_seconds: Пауза, после которой обобщается накопленный объем
+            min_idle_tokens: Минимальный объем для генерации тезисов по паузе
+            short_max_chars: Сообщения не длиннее этого и из одного-двух слов не учитываются в объеме
+                (но попадают в обобщение: короткий ответ вроде «35 лет» может быть важным фактом)
+            loader: Функция загрузки необобщенных сообщений пользователя из БД (после перезапуска)
+        """
+        self.token_threshold = token_threshold
+        self.idle_seconds = idle_seconds
+        self.min_idle_tokens = min_idle_tokens
+        self.short_max_chars = short_max_chars
+        self.loader = loader
+        self._states: Dict[int, _VolumeState] = {}
+        self._lock = threading.Lock()
+
+    def _counts_toward_volume(self, text: str) -> bool:
+        """Короткие реплики почти не добавляют объема и сами по себе не должны запускать генерацию"""
+        normalized = " ".join(_WORD_RE.findall(text.lower()))
+        if normalized in TRIVIAL_MESSAGES:
+            return False
+        return len(normalized) > self.short_max_chars or len(normalized.split()) > 2
+
+    def _volume(self, texts: List[str]) -> int:
+        return sum(estimate_tokens(text) for text in texts if self._counts_toward_volume(text))
+
+    def observe(self, user_id: int, text: str) -> bool:
+        now = time.time()
+        with self._lock:
+            state = self._states.get(user_id)
+        if state is None:
+            # Первое сообщение после запуска: восстанавливаем объем по БД (включая это сообщение)
+            tokens = self._volume(self.loader(user_id)) if self.loader else self._volume([text])
+            state = _VolumeState(tokens, now)
+            with self._lock:
+                self._states[user_id] = state
+        else:
+            if self._counts_toward_volume(text):
+                state.tokens += estimate_tokens(text)
+            state.last_activity = now
+
+        logger.debug("Необобщенный объем пользователя %s: ~%d токенов", user_id, state.tokens)
+        return state.tokens >= self.token_threshold
+
+    def due_idle(self, now: float = None) -> List[int]:
+        now = now or time.time()
+        due = []
+        with self._lock:
+            for user_id, state in self._states.items():
+                if state.tokens < self.min_idle_tokens:
+                    continue
+                if now - max(state.last_activity, state.last_idle_attempt) >= self.idle_seconds:
+                    state.last_idle_attempt = now
+                    due.append(user_id)
+        return due
+
+    def mark_summarized(self, user_id: int) -> None:
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is not None:
+                state.tokens = 0
+
+    def forget(self, user_id: int) -> None:
+        with self._lock:
+            self._states.pop(user_id, None)
+
+
+def create_policy(name: str, loader: Callable[[int], List[str]] = None, **options) -> ThesisTriggerPolicy:
+    """
+    Создает политику по имени
+
+    Args:
+        name: 'volume' (по объему и паузе) или 'every_n' (каждые N сообщений)
+        loader: Функция загрузки необобщенных сообщений пользователя
+        **options: Параметры политики
+
+    Returns:
+        Экземпляр политики
+    """
+    if name == "every_n":
+        return EveryNMessagesPolicy(every=options.get("every", 3))
+    if name == "volume":
+        return TokenVolumePolicy(
+            token_threshold=options.get("token_threshold", 600),
+            idle_seconds=options.get("idle_seconds", 900),
+            min_idle_tokens=options.get("min_idle_tokens", 40),
+            short_max_chars=options.get("short_max_chars", 12),
+            loader=loader
+        )
+    raise ValueError(f"Неизвестная политика генерации тезисов: {name}")